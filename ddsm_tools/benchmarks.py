@@ -0,0 +1,307 @@
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from ddsm_classes import ddsm_abnormality
+from ddsm_util import get_ics_info, get_abnormality_data
+from image_cache import raw_image_cache
+from image_codecs import check_level, codecs, codec_extension, image_writer, read_image, write_image
+from parse_ddsm_metadata import find_cases, iter_abnormalities, make_data_set, parse_case
+
+
+####################################################
+# Metadata parsing
+####################################################
+def bench_metadata(root, repeat=3):
+    """
+    Time a metadata-only pass over the corpus: walking the tree, parsing
+    every ICS and OVERLAY file and building every ddsm_abnormality
+    :param root: root of the cases tree
+    :param repeat: number of timed passes, the best is reported
+    :return: dictionary of timings in seconds and counts
+    """
+    start = time.time()
+    cases = find_cases(root)
+    walk_time = time.time() - start
+
+    best = None
+    count = 0
+    for _ in range(repeat):
+        start = time.time()
+        count = 0
+        for case in cases:
+            for abnormalities in parse_case(case):
+                count += len(abnormalities)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return {
+        'cases': len(cases),
+        'abnormalities': count,
+        'walk': walk_time,
+        'parse': best,
+        'abnormalities_per_second': count / best if best else None
+    }
+
+
+####################################################
+# Output codecs
+####################################################
+def _representative_images(root):
+    """
+    :param root: root of the cases tree
+    :return: dictionary of name -> image, the raw and uint8 od image of the first view
+    """
+    for abnormality, raw in iter_abnormalities(root, pixels='raw', prefetch=0):
+        raw = np.asarray(raw, dtype=np.uint16)
+        return {'raw': raw, 'od': abnormality._od_table()[raw]}
+    raise ValueError("No readable views under {}".format(root))
+
+
+def bench_codecs(root, level=None, copies=8, jobs=4):
+    """
+    Time every output codec on a raw and an od image from the corpus
+    :param root: root of the cases tree
+    :param level: compression level passed to the codecs that take it, see
+                  image_codecs.check_level, the others are timed at their default
+    :param copies: number of copies written to time parallel encoding
+    :param jobs: number of image_writer threads for parallel encoding
+    :return: list of dictionaries with bytes written and MB/s of uncompressed
+             pixels for encode, decode and parallel encode
+    """
+    images = _representative_images(root)
+    out_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        for name, im in sorted(images.items()):
+            mb = im.nbytes / 1024.0 ** 2
+            for codec in sorted(codecs):
+                path = os.path.join(out_dir, '{}.{}'.format(name, codec_extension(codec)))
+                try:
+                    check_level(codec, level)
+                    codec_level = level
+                except ValueError:
+                    codec_level = None
+
+                start = time.time()
+                write_image(path, im, codec, codec_level)
+                encode = time.time() - start
+
+                start = time.time()
+                read_image(path)
+                decode = time.time() - start
+
+                writer = image_writer(jobs)
+                start = time.time()
+                for i in range(copies):
+                    writer.submit('{}.{}'.format(path, i), im, codec, codec_level)
+                writer.wait()
+                parallel = time.time() - start
+                writer.close()
+
+                results.append({
+                    'image': name,
+                    'codec': codec,
+                    'level': codec_level,
+                    'bytes': os.path.getsize(path),
+                    'ratio': im.nbytes / float(os.path.getsize(path)),
+                    'encode_mbps': mb / encode,
+                    'decode_mbps': mb / decode,
+                    'parallel_encode_mbps': copies * mb / parallel
+                })
+    finally:
+        shutil.rmtree(out_dir)
+
+    return results
+
+
+####################################################
+# Pipeline stages
+####################################################
+def _best(fn, repeat, setup=None):
+    """
+    :param fn: callable to time
+    :param repeat: number of runs
+    :param setup: callable run before each run, not timed
+    :return: fastest run in seconds
+    """
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_stages(root, repeat=3):
+    """
+    Time each stage of the pipeline on its own over the whole corpus, then
+    make_data_set end to end. Image reads are from the page cache after the
+    first run, so _read_raw_image measures a warm cache.
+    :param root: root of the cases tree, e.g. from synthetic_corpus.make_synthetic_corpus
+    :param repeat: number of runs of each stage, the fastest is reported
+    :return: ordered dictionary of stage -> {'seconds': fastest run, 'items': items per run}
+    """
+    cases = find_cases(root)
+    overlays = [overlay for _, case_overlays in cases for overlay in case_overlays]
+    stages = OrderedDict()
+
+    stages['get_ics_info'] = {
+        'seconds': _best(lambda: [get_ics_info(case[0]) for case in cases], repeat),
+        'items': len(cases)
+    }
+    stages['get_abnormality_data'] = {
+        'seconds': _best(lambda: [get_abnormality_data(overlay) for overlay in overlays], repeat),
+        'items': len(overlays)
+    }
+
+    lesions = []
+    for ics_file_path, case_overlays in cases:
+        ics_dict = get_ics_info(ics_file_path)
+        for overlay in case_overlays:
+            for file_name, lesion_type, lesion_data in get_abnormality_data(overlay):
+                lesions.append((ddsm_abnormality(file_name, lesion_type, lesion_data, ics_dict), lesion_data))
+    stages['_chaincode2roi'] = {
+        'seconds': _best(lambda: [a._chaincode2roi(data) for a, data in lesions], repeat),
+        'items': len(lesions)
+    }
+
+    views = [abnormalities for case in cases for abnormalities in parse_case(case)]
+    abnormalities = [a for view in views for a in view]
+    stages['_read_raw_image'] = {
+        'seconds': _best(lambda: [np.array(view[0]._read_raw_image()) for view in views], repeat,
+                         setup=raw_image_cache.clear),
+        'items': len(views)
+    }
+
+    raws = [(view[0], np.array(view[0]._read_raw_image(), dtype=np.uint16)) for view in views]
+    with np.errstate(divide='ignore'):
+        stages['_od_correct'] = {
+            'seconds': _best(lambda: [a._od_correct(raw) for a, raw in raws], repeat),
+            'items': len(raws)
+        }
+    stages['od_table'] = {
+        'seconds': _best(lambda: [a._od_table()[raw] for a, raw in raws], repeat),
+        'items': len(raws)
+    }
+    raws = None
+
+    stages['crop'] = {
+        'seconds': _best(lambda: [a.image.crop(od_correct=True) for a in abnormalities], repeat),
+        'items': len(abnormalities)
+    }
+
+    out_dir = tempfile.mkdtemp()
+    try:
+        stages['save_mask'] = {
+            'seconds': _best(lambda: [a.save_mask(out_dir, force=True) for a in abnormalities], repeat),
+            'items': len(abnormalities)
+        }
+        stages['save_image_crop'] = {
+            'seconds': _best(lambda: [a.save_image(out_dir, crop=True, od_correct=True, force=True)
+                                      for a in abnormalities], repeat),
+            'items': len(abnormalities)
+        }
+        stages['save_image'] = {
+            'seconds': _best(lambda: [view[0].save_image(out_dir, od_correct=True, force=True)
+                                      for view in views], repeat),
+            'items': len(views)
+        }
+
+        def build():
+            data_set_dir = tempfile.mkdtemp(dir=out_dir)
+            make_data_set(root, data_set_dir, resume=False)
+
+        stages['make_data_set'] = {
+            'seconds': _best(build, repeat, setup=raw_image_cache.clear),
+            'items': len(abnormalities)
+        }
+    finally:
+        shutil.rmtree(out_dir)
+
+    return stages
+
+
+def record_results(stages, results_path, corpus=None):
+    """
+    Append a run to a json lines results file, tagged with the git commit
+    :param stages: output of bench_stages
+    :param results_path: results file
+    :param corpus: description of the corpus, e.g. the make_synthetic_corpus arguments
+    :return: the recorded entry
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    entry = {
+        'commit': commit,
+        'time': time.time(),
+        'host': socket.gethostname(),
+        'corpus': corpus,
+        'stages': stages
+    }
+    with open(results_path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    return entry
+
+
+def compare_results(results_path, base=-2, head=-1):
+    """
+    Print each stage of two recorded runs side by side
+    :param results_path: results file written by record_results
+    :param base: index of the baseline run
+    :param head: index of the run to compare
+    :return: dictionary of stage -> head seconds / base seconds
+    """
+    with open(results_path, 'r') as f:
+        entries = [json.loads(line, object_pairs_hook=OrderedDict) for line in f if line.strip()]
+    base, head = entries[base], entries[head]
+
+    print "stage                  {:>10} {:>10}  ratio".format(base['commit'], head['commit'])
+    ratios = {}
+    for stage, result in head['stages'].items():
+        if stage not in base['stages']:
+            continue
+        before, after = base['stages'][stage]['seconds'], result['seconds']
+        ratios[stage] = after / before if before else None
+        print "{:22} {:10.4f} {:10.4f} {:6.2f}".format(stage, before, after, ratios[stage] or 0)
+    return ratios
+
+
+if __name__ == '__main__':
+    # benchmarks.py root [metadata|codecs|stages [results.jsonl]]
+    bench = sys.argv[2] if len(sys.argv) > 2 else 'metadata'
+
+    if bench == 'metadata':
+        result = bench_metadata(sys.argv[1])
+        print "walked {cases} cases in {walk:.3f}s".format(**result)
+        print "parsed {abnormalities} abnormalities in {parse:.3f}s".format(**result)
+    elif bench == 'codecs':
+        print "image codec        bytes  ratio  encode MB/s  decode MB/s  parallel MB/s"
+        for r in bench_codecs(sys.argv[1]):
+            print "{image:5} {codec:12} {bytes:>9} {ratio:6.2f} {encode_mbps:12.1f} " \
+                  "{decode_mbps:12.1f} {parallel_encode_mbps:14.1f}".format(**r)
+    elif bench == 'stages':
+        stages = bench_stages(sys.argv[1])
+        for stage, result in stages.items():
+            print "{:22} {seconds:10.4f}s {items:6} items".format(stage, **result)
+
+        if len(sys.argv) > 3:
+            record_results(stages, sys.argv[3], corpus=sys.argv[1])
+            with open(sys.argv[3], 'r') as f:
+                if len(f.readlines()) > 1:
+                    compare_results(sys.argv[3])
@@ -0,0 +1,124 @@
+import json
+import os
+
+
+####################################################
+# Build manifest for incremental corpus builds
+####################################################
+def case_inputs(case):
+    """
+    Stat every file a case is built from. A .LJPEG.1 next to its .LJPEG is
+    written by the build itself, so only the .LJPEG counts, the .LJPEG.1 is
+    an input only in trees that come without the .LJPEG.
+    :param case: (ics_file_path, [overlay paths]) from find_cases
+    :return: dictionary of path -> [size, mtime]
+    """
+    ics_file_path, overlays = case
+    paths = [ics_file_path]
+    for overlay_path in overlays:
+        image_path = overlay_path[:-1 * len('.OVERLAY')] + '.LJPEG'
+        paths.extend([overlay_path, image_path if os.path.exists(image_path) else image_path + '.1'])
+
+    inputs = {}
+    for path in paths:
+        if os.path.exists(path):
+            st = os.stat(path)
+            inputs[path] = [st.st_size, st.st_mtime]
+    return inputs
+
+
+class build_manifest(object):
+    """
+    Record of what has been built for each case, so a rerun only redoes
+    cases whose inputs, output parameters or status changed.
+    Entries are appended to a json lines journal as cases finish, later
+    lines replace earlier ones for the same case, so a crash loses at
+    most the case being written.
+    """
+
+    def __init__(self, manifest_path, params):
+        """
+        :param manifest_path: path to the journal file
+        :param params: output parameters of this build, must be json serializable
+        """
+        self.manifest_path = manifest_path
+        self.params = json.loads(json.dumps(params))  # normalize tuples etc.
+        self.cases = {}
+        self._journal = None
+
+    def load(self):
+        """
+        Read an existing journal, ignoring a partly written last line
+        :return: None
+        """
+        if not os.path.exists(self.manifest_path):
+            return
+
+        with open(self.manifest_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.cases[entry['case']] = entry
+
+    def status(self, case, inputs):
+        """
+        :param case: (ics_file_path, [overlay paths])
+        :param inputs: output of case_inputs
+        :return: 'new' if the case was never built, 'done' if it is up to date,
+                 'stale' if it failed or its inputs or output parameters changed
+        """
+        entry = self.cases.get(case[0])
+        if entry is None:
+            return 'new'
+        if entry['status'] != 'done' or entry['inputs'] != inputs or entry['params'] != self.params:
+            return 'stale'
+        return 'done'
+
+    def rows(self, case):
+        return self.cases[case[0]]['rows']
+
+    def record(self, case, inputs, status, count, rows):
+        """
+        Record a finished case and append it to the journal
+        :param case: (ics_file_path, [overlay paths])
+        :param inputs: output of case_inputs
+        :param status: 'done' or 'failed'
+        :param count: number of abnormalities in the case
+        :param rows: csv rows of the case
+        :return: None
+        """
+        entry = {
+            'case': case[0],
+            'inputs': inputs,
+            'params': self.params,
+            'status': status,
+            'count': count,
+            'rows': rows
+        }
+        entry = json.loads(json.dumps(entry))
+        self.cases[case[0]] = entry
+
+        if self._journal is None:
+            self._journal = open(self.manifest_path, 'a')
+        self._journal.write(json.dumps(entry, sort_keys=True) + '\n')
+        self._journal.flush()
+
+    def compact(self, cases):
+        """
+        Rewrite the journal with one line per case still in the tree
+        :param cases: cases from find_cases
+        :return: None
+        """
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+        # sorted keys so the same entries always write the same bytes
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for case in cases:
+                if case[0] in self.cases:
+                    f.write(json.dumps(self.cases[case[0]], sort_keys=True) + '\n')
+        os.rename(tmp_path, self.manifest_path)
@@ -0,0 +1,156 @@
+import os
+from itertools import imap
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+from ddsm_classes import categories
+from prepare_lmdb import patient_splits, split_names
+
+
+####################################################
+# Build
+####################################################
+def _crop_view(task):
+    """
+    :param task: (ddsm_abnormality objects on one view, (width, height) to resize to)
+    :return: (n, height, width) uint8 od crops, None if the view can't be read
+    """
+    abnormalities, resize = task
+    crops = np.empty((len(abnormalities), resize[1], resize[0]), dtype=np.uint8)
+    try:
+        for idx, abnormality in enumerate(abnormalities):
+            im = abnormality.image.crop(od_correct=True)
+            crops[idx] = Image.fromarray(im).resize(resize, resample=Image.LINEAR)
+    except ValueError:
+        return None
+    return crops
+
+
+def build_crop_dataset(views, out_dir, resize=(64, 64), probs=(0.85, 0.05, 0.1), jobs=1, seed=0):
+    """
+    Pack the resized uint8 optical density crops of every abnormality into one
+    array file, with the categorical fields and a train/val/test split alongside
+    :param views: lists of ddsm_abnormality objects, one list per view, see parse_ddsm_metadata.iter_views
+    :param out_dir: directory for crops.npy and meta.npz, created if needed
+    :param resize: (width, height) of the crops
+    :param probs: (p_train, p_val, p_test) of patients, see prepare_lmdb.patient_split
+    :param jobs: number of processes cropping views
+    :param seed: seed of the splits
+    :return: crop_dataset of the new files
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    abnormalities = [a for view in views for a in view]
+    crops = np.lib.format.open_memmap(os.path.join(out_dir, 'crops.npy'), mode='w+', dtype=np.uint8,
+                                      shape=(len(abnormalities), resize[1], resize[0]))
+    valid = np.ones(len(abnormalities), dtype=bool)
+
+    tasks = [(view, resize) for view in views]
+    pool = None
+    if jobs > 1:
+        pool = Pool(jobs)
+        results = pool.imap(_crop_view, tasks)
+    else:
+        results = imap(_crop_view, tasks)
+
+    start = 0
+    for view, view_crops in zip(views, results):
+        if view_crops is None:
+            print "Error with abnormality at " + view[0].input_file_path
+            valid[start:start + len(view)] = False
+        else:
+            crops[start:start + len(view)] = view_crops
+        start += len(view)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    crops.flush()
+    del crops
+
+    splits = patient_splits([a.patient_id for a in abnormalities], probs, seed)
+    meta = {
+        'valid': valid,
+        'split': np.array([split_names.index(s) for s in splits], dtype=np.uint8),
+        'patient_id': np.array([a.patient_id for a in abnormalities], dtype=str),
+        'abn_num': np.array([int(a.abn_num) for a in abnormalities], dtype=np.int32),
+        'assessment': np.array([-1 if a.assessment is None else a.assessment for a in abnormalities], dtype=np.int32),
+        'subtlety': np.array([-1 if a.subtlety is None else a.subtlety for a in abnormalities], dtype=np.int32)
+    }
+    for field in sorted(categories):
+        meta[field] = np.array([getattr(a, '_' + field) for a in abnormalities], dtype=np.int16)
+        meta[field + '__categories'] = np.array(categories[field].values, dtype=str)
+
+    # written last, a dataset without meta.npz is incomplete
+    with open(os.path.join(out_dir, 'meta.npz'), 'wb') as f:
+        np.savez(f, **meta)
+
+    return crop_dataset(out_dir)
+
+
+####################################################
+# Read
+####################################################
+class crop_dataset(object):
+    """
+    Crops written by build_crop_dataset, memory mapped read-only. Worker
+    processes, forked or unpickled, index the same pages of the file, so
+    there is one copy of the crops in memory however many workers there are.
+    """
+
+    def __init__(self, path, label_field='mass_shape', split=None):
+        """
+        :param path: directory written by build_crop_dataset
+        :param label_field: categorical field whose codes are the labels
+        :param split: 'train', 'val' or 'test' to index only that split, None for all
+        """
+        self.path = path
+        self.label_field = label_field
+        self.split = split
+        self._open()
+
+    def _open(self):
+        self.crops = np.load(os.path.join(self.path, 'crops.npy'), mmap_mode='r')
+        with np.load(os.path.join(self.path, 'meta.npz')) as meta:
+            self.meta = dict((k, meta[k]) for k in meta.files)
+
+        keep = self.meta['valid'] & (self.meta[self.label_field] >= 0)
+        if self.split is not None:
+            keep &= self.meta['split'] == split_names.index(self.split)
+        self.indices = np.flatnonzero(keep)
+        self.labels = self.meta[self.label_field][self.indices]
+
+    def __getstate__(self):
+        return {'path': self.path, 'label_field': self.label_field, 'split': self.split}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        """
+        :param i: position in this dataset, or an array of positions
+        :return: (uint8 crop, label code), or stacked crops and codes for an array
+        """
+        return self.crops[self.indices[i]], self.labels[i]
+
+    def categories(self, field=None):
+        """
+        :param field: categorical field, defaults to label_field
+        :return: array of the values the codes of the field index
+        """
+        return self.meta[(field or self.label_field) + '__categories']
+
+    def column(self, field):
+        """
+        :param field: categorical field, patient_id, abn_num, assessment or subtlety
+        :return: the field for every crop in this dataset
+        """
+        return self.meta[field][self.indices]
@@ -0,0 +1,231 @@
+import csv
+import os
+import sys
+from multiprocessing import Pool
+
+import numpy as np
+
+from ddsm_classes import categories, select_mask
+from parse_ddsm_metadata import fields, find_cases, parse_case
+
+
+####################################################
+# Column types
+####################################################
+# every field in parse_ddsm_metadata.fields is stored as one of
+#   category: int16 codes into an array of strings, -1 for missing. Fields in
+#             ddsm_classes.categories keep their codes from there, the others
+#             are coded in sorted order
+#   int:      int32, -1 for missing
+#   float:    float64, nan for missing
+int_fields = ['abn_num', 'assessment', 'subtlety', 'breast_density',
+              'width', 'height', 'bpp', 'x_lo', 'y_lo', 'x_hi', 'y_hi']
+float_fields = ['resolution']
+category_fields = [f for f in fields + ['input_file_path'] if f not in int_fields + float_fields]
+
+# fields identifying an abnormality in ddsm_description_cases.csv
+key_fields = ['patient_id', 'side', 'view', 'abn_num']
+
+
+def _to_int(v):
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return -1
+
+
+def _to_float(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _case_records(case):
+    """
+    :param case: (ics_file_path, [overlay paths]) from find_cases
+    :return: list of (field dictionary, roi) for every abnormality in the case
+    """
+    records = []
+    for abnormalities in parse_case(case):
+        for abnormality in abnormalities:
+            record = dict((f, getattr(abnormality, f, None)) for f in fields)
+            record['input_file_path'] = abnormality.input_file_path
+            records.append((record, abnormality.roi))
+    return records
+
+
+####################################################
+# Build
+####################################################
+def build_catalog(root, catalog_path, data_set_dir=None, jobs=1):
+    """
+    Parse the metadata of every abnormality under root into a columnar catalog
+    :param root: root of the cases tree
+    :param catalog_path: .npz file to write
+    :param data_set_dir: output directory of make_data_set, output paths are
+                         filled in from its ddsm_description_cases.csv
+    :param jobs: number of worker processes
+    :return: ddsm_catalog of the new file
+    """
+    cases = find_cases(root)
+    if jobs > 1:
+        pool = Pool(jobs)
+        case_records = pool.map(_case_records, cases)
+        pool.close()
+        pool.join()
+    else:
+        case_records = map(_case_records, cases)
+
+    records = [r for recs in case_records for r in recs]
+
+    # output paths written by make_data_set
+    if data_set_dir is not None:
+        with open(os.path.join(data_set_dir, 'ddsm_description_cases.csv'), 'r') as f:
+            paths = {}
+            for row in csv.DictReader(f):
+                paths[tuple(row[k] for k in key_fields)] = row
+
+        for record, _ in records:
+            row = paths.get(tuple(str(record[k]) for k in key_fields))
+            if row is None:
+                continue
+            for f in ['od_img_path', 'od_crop_path', 'mask_path']:
+                record[f] = row[f] or None
+
+    columns = {}
+    for f in int_fields:
+        columns[f] = np.array([_to_int(r[f]) for r, _ in records], dtype=np.int32)
+    for f in float_fields:
+        columns[f] = np.array([_to_float(r[f]) for r, _ in records], dtype=np.float64)
+    for f in category_fields:
+        values = [r[f] for r, _ in records]
+        if f in categories:
+            columns[f] = np.array([categories[f].encode(v) for v in values], dtype=np.int16)
+            columns[f + '__categories'] = np.array(categories[f].values, dtype=str)
+        else:
+            values_seen = sorted(set(v for v in values if v is not None))
+            lookup = dict((c, i) for i, c in enumerate(values_seen))
+            columns[f] = np.array([lookup.get(v, -1) for v in values], dtype=np.int16)
+            columns[f + '__categories'] = np.array(values_seen, dtype=str)
+
+    # rois are stored back to back, roi i is roi_points[roi_offsets[i]:roi_offsets[i + 1]]
+    lengths = [len(roi) for _, roi in records]
+    columns['roi_offsets'] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    if records:
+        columns['roi_points'] = np.concatenate([roi for _, roi in records]).astype(np.int32)
+    else:
+        columns['roi_points'] = np.zeros((0, 2), dtype=np.int32)
+
+    with open(catalog_path, 'wb') as f:
+        np.savez(f, **columns)
+
+    return ddsm_catalog(catalog_path)
+
+
+####################################################
+# Query
+####################################################
+class ddsm_catalog(object):
+    """
+    Read side of a catalog written by build_catalog. Columns are only read
+    from disk when first used, and select() returns a catalog restricted
+    to the matching rows without copying any columns.
+    """
+
+    def __init__(self, catalog_path, rows=None, _data=None, _cache=None):
+        """
+        :param catalog_path: .npz file written by build_catalog
+        :param rows: indices of the rows in this selection, None for all rows
+        """
+        self.catalog_path = catalog_path
+        self._data = _data if _data is not None else np.load(catalog_path)
+        self._cache = _cache if _cache is not None else {}
+        if rows is None:
+            rows = np.arange(len(self._raw('roi_offsets')) - 1)
+        self.rows = rows
+
+    def _raw(self, name):
+        if name not in self._cache:
+            self._cache[name] = self._data[name]
+        return self._cache[name]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def categories(self, field):
+        """
+        :param field: category field
+        :return: array of the distinct values of the field
+        """
+        return self._raw(field + '__categories')
+
+    def codes(self, field):
+        """
+        :param field: category field
+        :return: int16 codes into categories(field) for the selected rows
+        """
+        return self._raw(field)[self.rows]
+
+    def column(self, field):
+        """
+        :param field: any field in parse_ddsm_metadata.fields or input_file_path
+        :return: array of values for the selected rows, None for missing categories
+        """
+        values = self._raw(field)[self.rows]
+        if field not in category_fields:
+            return values
+
+        categories = np.append(self.categories(field).astype(object), None)
+        return categories[values]  # code -1 picks the trailing None
+
+    def roi(self, i):
+        """
+        :param i: position in this selection
+        :return: int32 (N, 2) roi array
+        """
+        offsets = self._raw('roi_offsets')
+        row = self.rows[i]
+        return self._raw('roi_points')[offsets[row]:offsets[row + 1]]
+
+    def _column(self, field):
+        if field not in category_fields + int_fields + float_fields:
+            raise ValueError("Can't filter on {}".format(field))
+        return self._raw(field)[self.rows]
+
+    def _lookup(self, field, value):
+        """
+        :return: code of a category value in this catalog, -1 for None, None if it never occurs
+        """
+        if value is None:
+            return -1
+        key = field + '__lookup'
+        if key not in self._cache:
+            self._cache[key] = dict((c, i) for i, c in enumerate(self.categories(field)))
+        return self._cache[key].get(value)
+
+    def select(self, **criteria):
+        """
+        Restrict to rows matching every criterion, e.g.
+        select(abnormality_type='mass', pathology=['MALIGNANT', 'BENIGN'], assessment=4)
+        :param criteria: field=value or field=list of values, as in ddsm_classes.ddsm_batch.select
+        :return: ddsm_catalog of the matching rows
+        """
+        keep = select_mask(len(self.rows), criteria, self._column, self._lookup, int_fields + float_fields)
+        return ddsm_catalog(self.catalog_path, self.rows[keep], self._data, self._cache)
+
+    def to_dataframe(self, columns=None):
+        """
+        :param columns: fields to include, defaults to parse_ddsm_metadata.fields
+        :return: pandas DataFrame of the selected rows
+        """
+        import pandas as pd
+
+        if columns is None:
+            columns = fields
+        return pd.DataFrame(dict((c, self.column(c)) for c in columns), columns=columns)
+
+
+if __name__ == '__main__':
+    # ddsm_catalog.py root catalog_path [data_set_dir]
+    build_catalog(sys.argv[1], sys.argv[2], *sys.argv[3:4])
@@ -1,17 +1,175 @@
-from numpy import array, savetxt
+from numpy import savetxt
 import numpy as np
 import os
-from subprocess import call
 from PIL import Image, ImageDraw
+from threading import Lock
 
-from ddsm_util import get_value
+from ddsm_util import get_value, token_rows
+from image_cache import raw_image_cache
+from ljpeg import read_ljpeg
+from ljpeg_scheduler import decompress_ljpeg
+from image_codecs import codec_extension, write_image, write_npz
+from instrumentation import stats
 
 
 # hack because PIL doesn't like uint16
 Image._fromarray_typemap[((1, 1), "<u2")] = ("I", "I;16")
 
 
+####################################################
+# Categorical fields
+####################################################
+class category_codes(object):
+    """
+    Values of a categorical field and their integer codes. The values
+    listed up front always get the same codes, values not seen before
+    are appended as they turn up.
+    """
+
+    def __init__(self, values=()):
+        """
+        :param values: known values of the field
+        """
+        self.values = []
+        self.codes = {}
+        self._lock = Lock()
+        for value in values:
+            self.encode(value)
+
+    def encode(self, value):
+        """
+        :param value: field value, None for missing
+        :return: integer code, -1 for missing
+        """
+        if value is None:
+            return -1
+        code = self.codes.get(value)
+        if code is None:
+            # check again under the lock, another thread may have added it
+            with self._lock:
+                code = self.codes.get(value)
+                if code is None:
+                    code = len(self.values)
+                    self.values.append(value)
+                    self.codes[value] = code
+        return code
+
+    def decode(self, code):
+        """
+        :param code: integer code
+        :return: field value, None for missing
+        """
+        if code < 0:
+            return None
+        return self.values[code]
+
+    def lookup(self, value):
+        """
+        Code of a value without adding it
+        :param value: field value
+        :return: integer code, None if the value was never seen
+        """
+        if value is None:
+            return -1
+        return self.codes.get(value)
+
+
+# fields of ddsm_abnormality stored as codes, with the values in the DDSM documentation
+categories = {
+    'side': category_codes(['LEFT', 'RIGHT']),
+    'view': category_codes(['CC', 'MLO']),
+    'scanner_type': category_codes(['DBA', 'HOWTEK', 'LUMISYS']),
+    'scan_institution': category_codes(['MGH', 'WFU', 'ISMD']),
+    'abnormality_type': category_codes(['mass', 'calcification']),
+    'pathology': category_codes(['BENIGN', 'BENIGN_WITHOUT_CALLBACK', 'MALIGNANT', 'UNPROVEN']),
+    'mass_shape': category_codes(),
+    'mass_margins': category_codes(),
+    'calc_type': category_codes(),
+    'calc_distribution': category_codes()
+}
+
+
+def _category_property(field):
+    """
+    Attribute that reads and writes a categorical field through its code
+    :param field: key of categories
+    :return: property
+    """
+    slot = '_' + field
+    codes = categories[field]
+
+    def fget(self):
+        return codes.decode(getattr(self, slot))
+
+    def fset(self, value):
+        setattr(self, slot, codes.encode(value))
+
+    return property(fget, fset)
+
+
+def _int_value(value):
+    """
+    :param value: numeric field read from an overlay, None for missing
+    :return: int, None for missing
+    """
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError("Expected an integer, got {!r}".format(value))
+
+
+####################################################
+# Selection
+####################################################
+def select_mask(count, criteria, column, lookup, numeric_fields):
+    """
+    Rows matching every criterion. ddsm_batch and ddsm_catalog.ddsm_catalog
+    both select through this, so they take the same values: the strings of
+    categorical fields, and ints for numeric fields like assessment and subtlety.
+    :param count: number of rows
+    :param criteria: field=value or field=list of values, None matches missing values
+    :param column: callable taking a field, returns its stored values for the
+                   rows, codes for categorical fields, raises ValueError for unknown fields
+    :param lookup: callable taking a categorical field and a value, returns the
+                   code of the value, -1 for None, None if no row can have it
+    :param numeric_fields: fields stored as their values, -1 for missing
+    :return: boolean array of the matching rows
+    """
+    keep = np.ones(count, dtype=bool)
+    for field, value in criteria.items():
+        stored = column(field)
+        values = value if isinstance(value, (list, tuple, set)) else [value]
+        if field in numeric_fields:
+            values = [-1 if v is None else v for v in values]
+        else:
+            values = [lookup(field, v) for v in values]
+            values = [v for v in values if v is not None]
+        keep &= np.in1d(stored, values)
+    return keep
+
+
 class ddsm_abnormality(object):
+    # instances are kept for a whole corpus, so there is no per instance __dict__.
+    # categorical fields are stored as codes, see categories
+    __slots__ = ['input_file_path',
+                 'height',
+                 'width',
+                 'bpp',
+                 'resolution',
+                 'patient_id',
+                 'breast_density',
+                 'abn_num',
+                 'assessment',
+                 'subtlety',
+                 'roi',
+                 'x_lo',
+                 'y_lo',
+                 'x_hi',
+                 'y_hi',
+                 'outputs'] + ['_' + f for f in sorted(categories)]
+
     # index of data locations in overlay files
     idx = {
         'abn_num': 1,
@@ -27,17 +185,37 @@ class ddsm_abnormality(object):
         'distribution': 5,
     }
 
-    # hash mapping chain code to xy offsets
-    chain_hash = {
-        '0': (0, -1),
-        '1': (1, -1),
-        '2': (1, 0),
-        '3': (1, 1),
-        '4': (0, 1),
-        '5': (-1, 1),
-        '6': (-1, 0),
-        '7': (-1, -1)
-    }
+    # chain code to xy offsets, row i is the offset for code i
+    chain_lut = np.array([[0, -1],
+                          [1, -1],
+                          [1, 0],
+                          [1, 1],
+                          [0, 1],
+                          [-1, 1],
+                          [-1, 0],
+                          [-1, -1]], dtype=np.int32)
+
+    # optical density mapped linearly onto 255..0 in uint8 images
+    od_range = (0.0, 4.0)
+
+    # uint8 od lookup tables shared by all abnormalities, see _od_table
+    _od_tables = {}
+
+    # decompression logs of this process by path, see _decompress_ljpeg
+    _log_files = {}
+
+    # 'native' decodes LJPEG files in process, 'subprocess' decompresses them with
+    # jpegdir/jpeg. The bundled jpegdir/jpeg is a macOS build, native works
+    # everywhere and skips the .LJPEG.1 file, though the codec is faster where it
+    # runs, about 0.9 s against 2 s for a 4600x3000 view, see ljpeg.decode_ljpeg
+    ljpeg_decoder = 'native'
+
+    # directory decompressed images are read from and written to when there
+    # isn't one next to the LJPEG, None writes them next to it, see ljpeg_scheduler
+    scratch_dir = None
+
+    # images _decompress_ljpeg wrote to scratch_dir in this process, see remove_scratch_images
+    _scratch_images = []
 
     def __init__(self,
                  file_name,
@@ -45,6 +223,9 @@ class ddsm_abnormality(object):
                  data,
                  ics_dict):
 
+        # paths of images written for this abnormality, see ddsm_image.render
+        self.outputs = {}
+
         fname = os.path.basename(file_name)
         case_id, sequence, ext = fname.split('.')
 
@@ -68,18 +249,16 @@ class ddsm_abnormality(object):
         # abnormality information
         self.abn_num = get_value(data, 'ABNORMALITY', self.idx['abn_num'])
         self.abnormality_type = abnormality_type
-        self.assessment = get_value(data, 'ASSESSMENT', self.idx['assessment'])
+        self.assessment = _int_value(get_value(data, 'ASSESSMENT', self.idx['assessment']))
         self.pathology = get_value(data, 'PATHOLOGY', self.idx['pathology'])
-        self.subtlety = get_value(data, 'SUBTLETY', self.idx['subtlety'])
+        self.subtlety = _int_value(get_value(data, 'SUBTLETY', self.idx['subtlety']))
 
         # roi information
-        self.roi = self._chaincode2roi(data)
-        x = [xy[0] for xy in self.roi]
-        y = [xy[1] for xy in self.roi]
-        self.x_lo = min(x)
-        self.x_hi = max(x)
-        self.y_lo = min(y)
-        self.y_hi = max(y)
+        # roi is an (N, 2) int32 array of xy boundary points
+        with stats.time('chain_decode'):
+            self.roi = self._chaincode2roi(data)
+        self.x_lo, self.y_lo = [int(v) for v in self.roi.min(axis=0)]
+        self.x_hi, self.y_hi = [int(v) for v in self.roi.max(axis=0)]
 
         # calc/mass specific information
         self.calc_type = None
@@ -94,14 +273,45 @@ class ddsm_abnormality(object):
             self.calc_type = get_value(data, 'LESION_TYPE', self.idx['calc_type'])
             self.calc_distribution = get_value(data, 'LESION_TYPE', self.idx['distribution'])
 
-        # image information
-        self._raw_image = None
+    ###################################################
+    # Attributes
+    ###################################################
+    def __getattr__(self, name):
+        # output paths read like attributes, e.g. abnormality.od_crop_path
+        if not name.startswith('__'):
+            try:
+                return object.__getattribute__(self, 'outputs')[name]
+            except (AttributeError, KeyError):
+                pass
+        raise AttributeError("'ddsm_abnormality' object has no attribute '{}'".format(name))
+
+    def __getstate__(self):
+        # pickle values rather than codes, codes of values added
+        # after the known ones can differ between processes
+        state = {}
+        for name in self.__slots__:
+            if name.lstrip('_') in categories:
+                name = name.lstrip('_')
+            if hasattr(self, name):
+                state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def image(self):
+        """
+        :return: image_handle for this abnormality's view
+        """
+        return image_handle(self)
 
     ###################################################
     # ROI Methods
     ###################################################
     def write_roi(self):
-        savetxt(self.input_file_path + '_ROI.csv', array(self.roi), fmt='%d', delimiter=',')
+        savetxt(self.input_file_path + '_ROI.csv', self.roi, fmt='%d', delimiter=',')
 
     def _chaincode2roi(self, lst):
         # chain code lookup table
@@ -112,72 +322,134 @@ class ddsm_abnormality(object):
         """
 
         chain_idx = -1
-        for idx, l in enumerate(lst):
-            if l[0] == 'BOUNDARY':
-                chain_idx = idx + 1
-                break
+        if isinstance(lst, token_rows):
+            if lst.find('BOUNDARY') >= 0:
+                chain_idx = lst.find('BOUNDARY') + 1
+        else:
+            for idx, l in enumerate(lst):
+                if l[0] == 'BOUNDARY':
+                    chain_idx = idx + 1
+                    break
 
         if chain_idx < 0:
             exit("ERROR WITH CHAIN CODE")
 
-        x = int(lst[chain_idx][0])
-        y = int(lst[chain_idx][1])
+        start = np.array(lst[chain_idx][:2], dtype=np.int32)
         chain = lst[chain_idx][2:]
+        if '#' in chain:
+            chain = chain[:chain.index('#')]
 
-        code = []
-        code.append((x, y))
-        prev_coord = (x, y)
-        for c in chain:
-            if c == '#':
-                break
-            d = self.chain_hash[c]
-            new_coord = (prev_coord[0] + d[0], prev_coord[1] + d[1])
-            code.append(new_coord)
+        # codes are single digits, decode them all at once and
+        # accumulate the offsets from the starting point
+        codes = np.frombuffer(''.join(chain), dtype=np.uint8) - ord('0')
+        if (codes > 7).any():
+            raise ValueError("Bad chain code in {}".format(self.input_file_path))
 
-            prev_coord = new_coord
+        roi = np.empty((len(codes) + 1, 2), dtype=np.int32)
+        roi[0] = start
+        np.cumsum(self.chain_lut[codes], axis=0, out=roi[1:])
+        roi[1:] += start
 
-        return code
+        return roi
 
     ###################################################
     # Image Methods
     ###################################################
     def _decompress_ljpeg(self, log_file_path='ljpeg_decompression_log.txt'):
         """
-        :param im_path: base path for ljpeg
-        :param log_file_path: path to log for writing these
-        :return: None
+        Decompress the LJPEG with jpegdir/jpeg, into scratch_dir when it's set
+        :param log_file_path: path to log for the codec's output, opened once per process
+        :return: path of the .LJPEG.1 file
         """
-        with open(log_file_path, 'a') as log_file:
-            ljpeg_path = self.input_file_path + '.LJPEG'
-            if os.path.exists(ljpeg_path + '.1'):
-                log_file.write("Decompressed LJPEG Exists: " + ljpeg_path)
-            else:
-                call_lst = ['./jpegdir/jpeg', '-d', '-s', ljpeg_path]
-                call(call_lst, stdout=log_file)
+        log_file = self._log_files.get(log_file_path)
+        if log_file is None:
+            log_file = self._log_files[log_file_path] = open(log_file_path, 'a')
+
+        ljpeg_path = self.input_file_path + '.LJPEG'
+        with stats.time('ljpeg_decode', self.height * self.width * 2):
+            raw_im_path, output = decompress_ljpeg(ljpeg_path, self.scratch_dir, self.height * self.width * 2)
+        log_file.write(output)
+        log_file.flush()
+
+        if self.scratch_dir is not None:
+            self._scratch_images.append(raw_im_path)
 
         print "Decompressed {}".format(ljpeg_path)
+        return raw_im_path
+
+    @classmethod
+    def remove_scratch_images(cls):
+        """
+        Delete the images _decompress_ljpeg wrote to scratch_dir, once whatever
+        reads them is finished, the way ljpeg_scheduler.release does for its own
+        :return: None
+        """
+        while cls._scratch_images:
+            raw_im_path = cls._scratch_images.pop()
+            if os.path.exists(raw_im_path):
+                os.remove(raw_im_path)
+
+    def _raw_image_path(self):
+        """
+        :return: path of the decompressed image, next to the LJPEG or in scratch_dir,
+                 None if it hasn't been decompressed
+        """
+        raw_im_path = self.input_file_path + '.LJPEG.1'
+        if os.path.exists(raw_im_path):
+            return raw_im_path
+
+        if self.scratch_dir is not None:
+            raw_im_path = os.path.join(self.scratch_dir, os.path.basename(raw_im_path))
+            if os.path.exists(raw_im_path):
+                return raw_im_path
+        return None
 
     def _read_raw_image(self, force=False):
         """
-        Read in a raw image into a numpy array
+        Read in a raw image into a numpy array.
+        A decompressed .LJPEG.1 is memory mapped so only the pixels that are
+        used get read. Otherwise, with ljpeg_decoder = 'native', the image is
+        decoded in process. Either way the image is shared through raw_image_cache
+        so abnormalities on the same view only map or decode it once.
         :param force: boolean flag if we should force a read if we already have this image
-        :return: None
+        :return: raw image, possibly a read-only big-endian memmap
         """
+        if force:
+            raw_image_cache.discard(self.input_file_path)
+
+        raw_im_path = self._raw_image_path()
 
-        # only read if we haven't already or
-        # we aren't trying to force a read
-        if (self._raw_image is not None) and not force:
-            return
+        if raw_im_path is None and self.ljpeg_decoder == 'native':
+            try:
+                return raw_image_cache.get(self.input_file_path, self._decode_raw_image)
+            except ValueError:
+                print "Falling back to jpegdir/jpeg for {}".format(self.input_file_path)
 
         # make sure decompressed image exists
-        raw_im_path = self.input_file_path + '.LJPEG.1'
-        if not os.path.exists(raw_im_path):
-            self._decompress_ljpeg()
+        if raw_im_path is None:
+            raw_im_path = self._decompress_ljpeg()
 
-        # read it in and make it correct
-        im = np.fromfile(raw_im_path, dtype=np.uint16)
-        im.shape = (self.height, self.width)
-        self._raw_image = im.byteswap()  # switch endian
+        return raw_image_cache.get(self.input_file_path, lambda: self._map_raw_image(raw_im_path))
+
+    def _decode_raw_image(self):
+        """
+        Decode the LJPEG in process
+        :return: raw image
+        """
+        with stats.time('ljpeg_decode', self.height * self.width * 2):
+            im = read_ljpeg(self.input_file_path + '.LJPEG')
+        return im.reshape(self.height, self.width)
+
+    def _map_raw_image(self, raw_im_path):
+        """
+        Memory map a decompressed image, the file is big-endian 16 bit
+        :param raw_im_path: path to .LJPEG.1 file
+        :return: read-only memmap
+        """
+        if os.path.getsize(raw_im_path) != self.height * self.width * 2:
+            raise ValueError("{} does not match size {}x{}".format(raw_im_path, self.height, self.width))
+
+        return np.memmap(raw_im_path, dtype='>u2', mode='r', shape=(self.height, self.width))
 
     def _od_correct(self, im):
         """
@@ -185,8 +457,6 @@ class ddsm_abnormality(object):
         :param im: image
         :return: optical density image
         """
-        im_od = np.zeros_like(im, dtype=np.float64)
-
         if (self.scan_institution == 'MGH') and (self.scanner_type == 'DBA'):
             im_od = (np.log10(im + 1) - 4.80662) / -1.07553  # add 1 to keep from log(0)
         elif (self.scan_institution == 'MGH') and (self.scanner_type == 'HOWTEK'):
@@ -195,11 +465,130 @@ class ddsm_abnormality(object):
             im_od = (im - 4096.99) / -1009.01
         elif (self.scan_institution == 'ISMD') and (self.scanner_type == 'HOWTEK'):
             im_od = (-0.00099055807612 * im) + 3.96604095240593
+        else:
+            im_od = np.zeros(im.shape, dtype=np.float64)
 
         # perform heath noise correction
-        im_od[im_od < 0.05] = 0.05
-        im_od[im_od > 3.0] = 3.0
-        return im_od
+        return np.clip(im_od, 0.05, 3.0, out=im_od)
+
+    def _od_table(self):
+        """
+        uint8 optical density of every 16 bit gray level for this scanner,
+        so converting an image is a single lookup
+        :return: uint8 array of length 65536
+        """
+        key = (self.scan_institution, self.scanner_type, self.od_range)
+        table = self._od_tables.get(key)
+        if table is None:
+            with np.errstate(divide='ignore'):  # 65535 + 1 wraps to 0 for DBA
+                levels = self._od_correct(np.arange(65536, dtype=np.uint16))
+            table = np.interp(levels, self.od_range, (255, 0)).astype(np.uint8)
+            self._od_tables[key] = table
+        return table
+
+    def _crop_bounds(self):
+        """
+        Square crop around the roi, clipped to the image
+        :return: (cy_lo, cy_hi, cx_lo, cx_hi)
+        """
+        #crop bounds
+        cy_lo, cy_hi, cx_lo, cx_hi = self.y_lo, self.y_hi, self.x_lo, self.x_hi
+
+        # square crop
+        height = self.y_hi-self.y_lo
+        width = self.x_hi-self.x_lo
+
+        if height > width:
+            diff = height - width
+            pad = int(np.floor(diff/2))
+            cx_lo -= pad
+            cx_hi += pad
+            if diff % 2 == 1:  # is odd
+                cx_hi += 1
+
+        if height < width:
+            diff = width - height
+            pad = int(np.floor(diff/2))
+            cy_lo -= pad
+            cy_hi += pad
+            if diff % 2 == 1:  # is odd
+                cy_hi += 1
+
+        cx_lo = max(0, cx_lo)
+        cy_lo = max(0, cy_lo)
+        cx_hi = min(self.width, cx_hi)
+        cy_hi = min(self.height, cy_hi)
+
+        return cy_lo, cy_hi, cx_lo, cx_hi
+
+    def _crop_empty(self):
+        """
+        :return: True if the crop has no pixels, the roi is outside the image
+        """
+        cy_lo, cy_hi, cx_lo, cx_hi = self._crop_bounds()
+        return cy_hi <= cy_lo or cx_hi <= cx_lo
+
+    def _image_path(self, out_dir=None, out_name=None, crop=False, codec='tiff'):
+        """
+        :param out_dir: directory to put this image, defaults to the case directory
+        :param out_name: name of file, defaults to the view name (plus abn_num for crops)
+        :param crop: whether this is a crop of the lesion
+        :param codec: output codec, see image_codecs
+        :return: path of the image
+        """
+        ext = codec_extension(codec)
+        if out_dir is None:
+            out_dir = os.path.split(self.input_file_path)[0]
+
+        if out_name is None:
+            if crop:
+                out_name = "{}_{}.{}".format(os.path.split(self.input_file_path)[1], self.abn_num, ext)
+            else:
+                out_name = "{}.{}".format(os.path.split(self.input_file_path)[1], ext)
+
+        return os.path.join(out_dir, out_name)
+
+    def _write_image(self, im_path, im_array, crop=False, od_correct=False, resize=None,
+                     codec='tiff', level=None, writer=None):
+        """
+        Transform and write an image
+        :param im_path: output path
+        :param im_array: full raw image, or full uint8 od image
+        :param crop: boolean to decide whether to crop lesion
+        :param od_correct: boolean to convert a raw image to optical density
+        :param resize: (width, height) to resize to
+        :param codec: output codec, see image_codecs
+        :param level: compression level of the codec
+        :param writer: image_codecs.image_writer to encode on, None writes before returning
+        :return: None
+        """
+        # crops are views, so only the rows and columns inside the
+        # crop get read from a memory mapped image
+        if crop:
+            with stats.time('crop'):
+                cy_lo, cy_hi, cx_lo, cx_hi = self._crop_bounds()
+                im_array = im_array[cy_lo:cy_hi, cx_lo:cx_hi]
+
+        # convert to optical density, unless ddsm_image._od already has
+        if od_correct and im_array.dtype != np.uint8:
+            with stats.time('od', im_array.nbytes):
+                im_array = self._od_table()[im_array]
+
+        # native byte order copy of the pixels being written
+        if im_array.dtype != np.uint8:
+            with stats.time('raw_read', im_array.nbytes):
+                im_array = im_array.astype(np.uint16)
+
+        # resize if necessary
+        if resize:
+            with stats.time('resize'):
+                im_array = np.array(Image.fromarray(im_array).resize(resize, resample=Image.LINEAR))
+
+        # save image
+        if writer is not None:
+            writer.submit(im_path, im_array, codec, level)
+        else:
+            write_image(im_path, im_array, codec, level)
 
     # todo fix output paths
     def save_image(self,
@@ -209,7 +598,9 @@ class ddsm_abnormality(object):
                    od_correct=False,
                    make_dtype=None,
                    resize=None,
-                   force=False):
+                   force=False,
+                   codec='tiff',
+                   level=None):
         """
         save the image data as a tiff file (without correction)
         :param out_dir: directory to put this image
@@ -218,94 +609,64 @@ class ddsm_abnormality(object):
         :param od_correct: boolean to decide to perform od_correction
         :param make_dtype: boolean to switch to 8-bit encoding
         :param force: force if this image already exists
+        :param codec: output codec, see image_codecs, 'tiles' saves a tiled image with downsampled levels
+        :param level: compression level of the codec
         :return: path of the image
         """
-        # construct image path
-        if out_dir is None:
-            out_dir = os.path.split(self.input_file_path)[0]
-
-        if out_name is None:
-            if crop:
-                out_name = "{}_{}.tif".format(os.path.split(self.input_file_path)[1], self.abn_num)
-            else:
-                out_name = "{}.tif".format(os.path.split(self.input_file_path)[1])
-
-        im_path = os.path.join(out_dir, out_name)
+        im_path = self._image_path(out_dir, out_name, crop, codec)
 
         # don't write if image exists and we aren't forcing it
         if os.path.exists(im_path) and not force:
             return im_path
 
-        # make sure we have an image to save
-        if self._raw_image is None:
-            self._read_raw_image()
-
-        im_array = np.copy(self._raw_image)
-
-        # do appropriate image transformations
-        # save resultant location for csv writing later
-        if crop:
-            #crop bounds
-            cy_lo, cy_hi, cx_lo, cx_hi = self.y_lo, self.y_hi, self.x_lo, self.x_hi
-
-            # square crop
-            height = self.y_hi-self.y_lo
-            width = self.x_hi-self.x_lo
-
-            if height > width:
-                diff = height - width
-                pad = int(np.floor(diff/2))
-                cx_lo -= pad
-                cx_hi += pad
-                if diff % 2 == 1:  # is odd
-                    cx_hi += 1
-
-            if height < width:
-                diff = width - height
-                pad = int(np.floor(diff/2))
-                cy_lo -= pad
-                cy_hi += pad
-                if diff % 2 == 1:  # is odd
-                    cy_hi += 1
-
-            cx_lo = max(0, cx_lo)
-            cy_lo = max(0, cy_lo)
-            cx_hi = min(self.width, cx_hi)
-            cy_hi = min(self.height, cy_hi)
-
-            im_array = im_array[cy_lo:cy_hi, cx_lo:cx_hi]
-
-        # convert to optical density
-        if od_correct:
-            im_array = self._od_correct(im_array)
-            im_array = np.interp(im_array, (0.0, 4.0), (255, 0))
-            im_array = im_array.astype(np.uint8)
-
         if make_dtype == 'uint8':
             pass
 
-        # create image object
-        im = Image.fromarray(im_array)
+        self._write_image(im_path, self._read_raw_image(), crop, od_correct, resize, codec, level)
 
-        # resize if necessary
-        if resize:
-            im = im.resize(resize, resample=Image.LINEAR)
+        # return location of image
+        return im_path
 
+    def roi_mask(self):
+        """
+        Rasterize the roi inside its bounding box only, clipped to the image
+        :return: (boolean mask, (row, col) of the mask's top left corner in the image),
+                 the mask is empty for an roi entirely outside the image
+        """
+        x_lo, y_lo = min(max(0, self.x_lo), self.width), min(max(0, self.y_lo), self.height)
+        x_hi, y_hi = min(self.width - 1, self.x_hi), min(self.height - 1, self.y_hi)
 
-        # save image
-        im.save(im_path, 'tiff')
+        if x_hi < x_lo or y_hi < y_lo:
+            return np.zeros((0, 0), dtype=bool), (y_lo, x_lo)
 
-        # return location of image
-        return im_path
+        img = Image.new('1', (x_hi - x_lo + 1, y_hi - y_lo + 1), 0)
+        ImageDraw.Draw(img).polygon((self.roi - (x_lo, y_lo)).ravel().tolist(), outline=1, fill=1)
+        return np.array(img, dtype=bool), (y_lo, x_lo)
 
     # TODO save mask
-    def save_mask(self, out_dir=None, out_name=None, force=False):
+    def save_mask(self, out_dir=None, out_name=None, force=False, compact=False, codec='tiff', level=None):
+        """
+        save the lesion mask
+        :param out_dir: directory to put this mask
+        :param out_name: name of file to save mask as
+        :param force: force if this mask already exists
+        :param compact: save only the bounding box of the roi with its offset as .npz
+                        instead of a full size tiff, see load_mask. These are
+                        always compressed, level is for the codec.
+        :param codec: output codec of full size masks, see image_codecs, except tiles
+        :param level: compression level of the codec, see image_codecs.check_level
+        :return: path of the mask
+        """
+        if codec == 'tiles':
+            raise ValueError("Masks can't be saved as tiles")
+
          # construct image path
         if out_dir is None:
             out_dir = os.path.split(self.input_file_path)[0]
 
         if out_name is None:
-            out_name = "{}_{}.tif".format(os.path.split(self.input_file_path)[1], self.abn_num)
+            ext = 'npz' if compact else codec_extension(codec)
+            out_name = "{}_{}.{}".format(os.path.split(self.input_file_path)[1], self.abn_num, ext)
 
         im_path = os.path.join(out_dir, out_name)
 
@@ -313,9 +674,23 @@ class ddsm_abnormality(object):
         if os.path.exists(im_path) and not force:
             return im_path
 
-        img = Image.new('1', (self.width, self.height), 0)
-        ImageDraw.Draw(img).polygon(self.roi, outline=1, fill=1)
-        img.save(im_path, 'tiff')
+        if compact:
+            with stats.time('mask'):
+                mask, offset = self.roi_mask()
+            with stats.time('write', mask.nbytes):
+                write_npz(im_path, mask=mask, offset=offset, shape=(self.height, self.width))
+            return im_path
+
+        with stats.time('mask'):
+            img = Image.new('1', (self.width, self.height), 0)
+            ImageDraw.Draw(img).polygon(self.roi.ravel().tolist(), outline=1, fill=1)
+            mask = np.array(img, dtype=bool)
+        if codec == 'npz':
+            # same layout as a compact mask, so load_mask reads it
+            with stats.time('write', mask.nbytes):
+                write_npz(im_path, level, mask=mask, offset=(0, 0), shape=(self.height, self.width))
+        else:
+            write_image(im_path, mask, codec, level)
 
         return im_path
 
@@ -341,4 +716,229 @@ class ddsm_abnormality(object):
                    self.pathology,
                    self.input_file_path)
 
-        return s
\ No newline at end of file
+        return s
+
+
+# categorical attributes of ddsm_abnormality
+for _field in categories:
+    setattr(ddsm_abnormality, _field, _category_property(_field))
+
+
+class image_handle(object):
+    """
+    Lazy access to the pixels of an abnormality's view. Nothing is held
+    between calls, decoded and memory mapped images live in raw_image_cache,
+    so handles can be kept for a whole corpus.
+    """
+    __slots__ = ['abnormality']
+
+    def __init__(self, abnormality):
+        """
+        :param abnormality: ddsm_abnormality
+        """
+        self.abnormality = abnormality
+
+    @property
+    def shape(self):
+        return self.abnormality.height, self.abnormality.width
+
+    def raw(self):
+        """
+        :return: raw image
+        """
+        return self.abnormality._read_raw_image()
+
+    def od(self):
+        """
+        :return: uint8 optical density image
+        """
+        return self.abnormality._od_table()[self.raw()]
+
+    def crop(self, od_correct=False):
+        """
+        :param od_correct: convert the crop to uint8 optical density
+        :return: square crop around the roi, as in save_image
+        """
+        cy_lo, cy_hi, cx_lo, cx_hi = self.abnormality._crop_bounds()
+        im = self.raw()[cy_lo:cy_hi, cx_lo:cx_hi]
+        if od_correct:
+            return self.abnormality._od_table()[im]
+        return np.array(im, dtype=np.uint16)
+
+
+class ddsm_batch(object):
+    """
+    Abnormalities with their categorical codes and bounds in a numpy
+    structured array, for vectorized filtering of a whole corpus.
+    """
+    # int32 columns, -1 for missing
+    numeric_fields = ['assessment', 'subtlety', 'width', 'height', 'x_lo', 'y_lo', 'x_hi', 'y_hi']
+
+    def __init__(self, abnormalities, table=None):
+        """
+        :param abnormalities: ddsm_abnormality objects
+        :param table: structured array of the abnormalities, built if None
+        """
+        self.abnormalities = list(abnormalities)
+        if table is None:
+            table = self._make_table(self.abnormalities)
+        self.table = table
+
+    @classmethod
+    def _make_table(cls, abnormalities):
+        dtype = [(f, np.int16) for f in sorted(categories)] + [(f, np.int32) for f in cls.numeric_fields]
+        table = np.empty(len(abnormalities), dtype=dtype)
+        for f in sorted(categories):
+            table[f] = [getattr(a, '_' + f) for a in abnormalities]
+        for f in cls.numeric_fields:
+            table[f] = [-1 if getattr(a, f) is None else getattr(a, f) for a in abnormalities]
+        return table
+
+    def __len__(self):
+        return len(self.abnormalities)
+
+    def __iter__(self):
+        return iter(self.abnormalities)
+
+    def __getitem__(self, i):
+        return self.abnormalities[i]
+
+    def _column(self, field):
+        if field not in self.table.dtype.names:
+            raise ValueError("Can't filter on {}".format(field))
+        return self.table[field]
+
+    def mask(self, **criteria):
+        """
+        :param criteria: field=value or field=list of values, for categorical
+                         and numeric fields, see select_mask
+        :return: boolean array of the abnormalities matching every criterion
+        """
+        return select_mask(len(self.table), criteria, self._column,
+                           lambda field, value: categories[field].lookup(value), self.numeric_fields)
+
+    def select(self, **criteria):
+        """
+        Restrict to abnormalities matching every criterion, e.g.
+        select(abnormality_type='mass', pathology=['MALIGNANT', 'BENIGN'], assessment=4)
+        :param criteria: as in mask
+        :return: ddsm_batch of the matching abnormalities
+        """
+        idx = np.flatnonzero(self.mask(**criteria))
+        return ddsm_batch([self.abnormalities[i] for i in idx], self.table[idx])
+
+    def column(self, field):
+        """
+        :param field: categorical or numeric field
+        :return: array of the field's values, None or -1 for missing
+        """
+        if field in categories:
+            values = np.array(categories[field].values + [None], dtype=object)
+            return values[self.table[field]]  # code -1 picks the trailing None
+        return self.table[field]
+
+
+def load_mask(mask_path, full=True):
+    """
+    Load a mask written by save_mask
+    :param mask_path: path to a full size tiff or png mask, or an .npz mask
+    :param full: rebuild the full size mask, otherwise return the compact form
+    :return: full size boolean mask, or (boolean mask, (row, col) offset, image shape)
+    """
+    if mask_path.endswith('.npz'):
+        with np.load(mask_path) as data:
+            mask, offset, shape = data['mask'], tuple(data['offset']), tuple(data['shape'])
+    else:
+        mask = np.array(Image.open(mask_path), dtype=bool)
+        offset, shape = (0, 0), mask.shape
+
+    if not full:
+        return mask, offset, shape
+
+    full_mask = np.zeros(shape, dtype=bool)
+    full_mask[offset[0]:offset[0] + mask.shape[0], offset[1]:offset[1] + mask.shape[1]] = mask
+    return full_mask
+
+
+class ddsm_image(object):
+    """
+    All abnormalities on one view, rendered together so the view is
+    decoded and converted to optical density once however many lesions
+    and outputs there are.
+    """
+
+    def __init__(self, abnormalities):
+        """
+        :param abnormalities: ddsm_abnormality objects sharing an input_file_path
+        """
+        self.abnormalities = abnormalities
+        self.input_file_path = abnormalities[0].input_file_path
+
+        self._raw_image = None
+        self._od_image = None
+
+    def _raw(self):
+        if self._raw_image is None:
+            self._raw_image = self.abnormalities[0].image.raw()
+        return self._raw_image
+
+    def _od(self):
+        if self._od_image is None:
+            raw = self._raw()
+            if isinstance(raw, np.memmap):
+                # page in the whole decompressed image at once, the lookup reads all of it
+                with stats.time('raw_read', raw.nbytes):
+                    raw = raw.astype(np.uint16)
+            with stats.time('od', raw.nbytes):
+                self._od_image = self.abnormalities[0]._od_table()[raw]
+        return self._od_image
+
+    def render(self, plan, force=False, writer=None):
+        """
+        Write every output in the plan for every abnormality. Each output's path
+        is stored in the abnormalities' outputs under its key, and reads like an attribute.
+        Full images are written once per view, the optical density image is
+        computed at most once, and crops are cut from it when it exists.
+        :param plan: dictionary of attribute name -> output options, e.g.
+            {'od_img_path': {'out_dir': od_dir, 'od_correct': True},
+             'od_crop_path': {'out_dir': od_crop_dir, 'od_correct': True, 'crop': True},
+             'od_resized_crop_path': {'out_dir': d, 'od_correct': True, 'crop': True, 'resize': (256, 256)},
+             'mask_path': {'out_dir': mask_dir, 'mask': True}}
+            options are out_dir, out_name, crop, od_correct, resize, codec and level as in
+            save_image, or mask=True with out_dir, out_name, compact, codec and level as in save_mask
+        :param force: rewrite outputs that already exist
+        :param writer: image_codecs.image_writer to encode images on while the next
+                       ones are made, the caller waits on it before using the files
+        :return: None
+        """
+        # full images first so crops can reuse the od image
+        attrs = sorted(plan, key=lambda k: bool(plan[k].get('crop') or plan[k].get('mask')))
+
+        for attr in attrs:
+            opts = dict(plan[attr])
+            if opts.pop('mask', False):
+                for abnormality in self.abnormalities:
+                    abnormality.outputs[attr] = abnormality.save_mask(force=force, **opts)
+                continue
+
+            crop = opts.get('crop', False)
+            od_correct = opts.get('od_correct', False)
+            codec = opts.get('codec', 'tiff')
+            for idx, abnormality in enumerate(self.abnormalities):
+                # an roi outside the image has nothing to crop, skip only its crop
+                if crop and abnormality._crop_empty():
+                    print "Skipping crop of abnormality {} on {}, its roi is outside the image".format(
+                        abnormality.abn_num, abnormality.input_file_path)
+                    continue
+
+                im_path = abnormality._image_path(opts.get('out_dir'), opts.get('out_name'), crop, codec)
+
+                if (crop or idx == 0) and (force or not os.path.exists(im_path)):
+                    if od_correct and (not crop or self._od_image is not None):
+                        im_array = self._od()
+                    else:
+                        im_array = self._raw()
+                    abnormality._write_image(im_path, im_array, crop, od_correct, opts.get('resize'),
+                                             codec, opts.get('level'), writer)
+
+                abnormality.outputs[attr] = im_path
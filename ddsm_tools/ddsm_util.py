@@ -1,5 +1,40 @@
 import os
 
+
+####################################################
+# Tokenized files indexed by row keyword
+####################################################
+class token_rows(list):
+    """
+    List of whitespace split rows that also keeps the position of the
+    first row starting with each keyword, so lookups don't scan the rows
+    """
+
+    def __init__(self, rows):
+        super(token_rows, self).__init__(rows)
+        self.positions = {}
+        for pos, row in enumerate(self):
+            if row and row[0] not in self.positions:
+                self.positions[row[0]] = pos
+
+    def find(self, row_name):
+        """
+        :param row_name: keyword at the start of the row
+        :return: position of the first row starting with row_name, -1 if none
+        """
+        return self.positions.get(row_name, -1)
+
+
+def read_tokens(file_path):
+    """
+    Read a file once and split it into rows of whitespace separated tokens
+    :param file_path: path to ics or overlay file
+    :return: token_rows, including empty rows for blank lines
+    """
+    with open(file_path, 'r') as f:
+        return token_rows([s.split() for s in f.read().splitlines()])
+
+
 ####################################################
 # Extract value from split list of data
 ####################################################
@@ -10,8 +45,16 @@ def get_value(lst, row_name, idx):
     :param idx: numeric index of desired value
     :return: value
     """
+    if isinstance(lst, token_rows):
+        pos = lst.find(row_name)
+        if pos < 0:
+            return None
+        rows = [lst[pos]]
+    else:
+        rows = lst
+
     val = None
-    for l in lst:
+    for l in rows:
         if not l:
             continue
 
@@ -48,27 +91,29 @@ def get_ics_info(ics_file_path):
     letter = ics_file_name[0]
 
     # get data from ics file
-    with open(ics_file_path, 'r') as f:
-        lines = map(lambda s: s.strip().split(), f.readlines())
+    lines = read_tokens(ics_file_path)
 
     # map ics data to values
+    scanner_type = get_value(lines, 'DIGITIZER', 1)
     ics_dict = {
         'patient_id': get_value(lines, 'filename', 1),
         'age': get_value(lines, 'PATIENT_AGE', 1),
-        'scanner_type': get_value(lines, 'DIGITIZER', 1),
-        'scan_institution': scanner_map[(letter, get_value(lines, 'DIGITIZER', 1))],
+        'scanner_type': scanner_type,
+        'scan_institution': scanner_map[(letter, scanner_type)],
         'density': get_value(lines, 'DENSITY', 1)
     }
 
     for sequence in ['LEFT_CC', 'RIGHT_CC', 'LEFT_MLO', 'RIGHT_MLO']:
-        if get_value(lines, sequence, 0) is None:
+        pos = lines.find(sequence)
+        if pos < 0:
             continue
 
+        row = lines[pos]
         sequence_dict = {
-            'height': int(get_value(lines, sequence, 2)),
-            'width': int(get_value(lines, sequence, 4)),
-            'bpp': int(get_value(lines, sequence, 6)),
-            'resolution': float(get_value(lines, sequence, 8))
+            'height': int(row[2]),
+            'width': int(row[4]),
+            'bpp': int(row[6]),
+            'resolution': float(row[8])
         }
 
         ics_dict[sequence] = sequence_dict
@@ -86,9 +131,7 @@ def get_abnormality_data(file_name):
     """
 
     # read lines, strip newlines, split them by whitespace, remove empty lines
-    with open(file_name, 'r') as file_ptr:
-        lines = map(lambda s: s.strip().split(), file_ptr.readlines())
-        lines = filter(lambda l: l != [], lines)
+    lines = filter(lambda l: l != [], read_tokens(file_name))
     try:
         total_abnormalities = int(lines[0][1])
     except:
@@ -107,7 +150,7 @@ def get_abnormality_data(file_name):
 
     abnormality_data = []
     for idx in range(len(abnormal_idx) - 1):
-        lesion_data = lines[abnormal_idx[idx]:abnormal_idx[idx + 1]]
+        lesion_data = token_rows(lines[abnormal_idx[idx]:abnormal_idx[idx + 1]])
         lesion_type = lesion_data[1][1].lower()
         abnormality_data.append((file_name, lesion_type, lesion_data))
 
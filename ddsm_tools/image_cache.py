@@ -0,0 +1,110 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+####################################################
+# Process-wide decoded image cache
+####################################################
+class image_cache(object):
+    """
+    LRU cache of decoded images bounded by a byte budget.
+    Images are keyed by the abnormality's input_file_path so every
+    abnormality on the same view shares a single decoded array or memmap.
+    A memmap counts its full size against the budget.
+    """
+
+    def __init__(self, max_bytes=512 * 1024 ** 2):
+        """
+        :param max_bytes: total size of cached arrays before evicting
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._images = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, loader):
+        """
+        Fetch an image from the cache, loading it on a miss
+        :param key: cache key, normally an input_file_path
+        :param loader: callable taking no arguments that returns the image array
+        :return: image array
+        """
+        with self._lock:
+            if key in self._images:
+                im = self._images.pop(key)
+                self._images[key] = im  # move to most recently used
+                self.hits += 1
+                return im
+            self.misses += 1
+
+        # load outside of the lock so other readers aren't blocked
+        im = loader()
+        self.put(key, im)
+        return im
+
+    def put(self, key, im):
+        """
+        Insert an image, evicting the least recently used images to stay in budget
+        :param key: cache key
+        :param im: image array
+        :return: None
+        """
+        with self._lock:
+            if key in self._images:
+                self.nbytes -= self._images.pop(key).nbytes
+
+            # images larger than the budget are never cached
+            if im.nbytes > self.max_bytes:
+                return
+
+            self._images[key] = im
+            self.nbytes += im.nbytes
+            while self.nbytes > self.max_bytes:
+                _, old = self._images.popitem(last=False)
+                self.nbytes -= old.nbytes
+                self.evictions += 1
+
+    def discard(self, key):
+        """
+        Remove an image from the cache if present
+        :param key: cache key
+        :return: None
+        """
+        with self._lock:
+            if key in self._images:
+                self.nbytes -= self._images.pop(key).nbytes
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """
+        :return: dictionary of cache counters
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'images': len(self._images),
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes
+            }
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._images
+
+    def __len__(self):
+        with self._lock:
+            return len(self._images)
+
+
+# shared by every ddsm_abnormality in this process
+raw_image_cache = image_cache()
@@ -0,0 +1,173 @@
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from PIL import Image
+
+from instrumentation import stats
+from tiled_image import tiled_image, write_tiled
+
+# hack because PIL doesn't like uint16
+Image._fromarray_typemap[((1, 1), "<u2")] = ("I", "I;16")
+
+
+####################################################
+# Output codecs
+####################################################
+# name -> file extension
+#   tiff          uncompressed tiff, what save_image has always written, takes no level
+#   tiff_deflate  zip compressed tiff, takes no level, Pillow doesn't set the zip level
+#   tiff_lzw      lzw compressed tiff, takes no level
+#   png           png, level is the zlib level (default 6)
+#   npz           numpy savez_compressed under the key 'image', level 0 writes
+#                 np.savez uncompressed, numpy has no other levels
+#   tiles         tiled image with downsampled levels, level is the zlib level (default 1)
+codecs = {
+    'tiff': 'tif',
+    'tiff_deflate': 'tif',
+    'tiff_lzw': 'tif',
+    'png': 'png',
+    'npz': 'npz',
+    'tiles': 'tiles'
+}
+
+
+def codec_extension(codec):
+    """
+    :param codec: key of codecs
+    :return: file extension of the codec
+    """
+    if codec not in codecs:
+        raise ValueError("Unknown codec {}, expected one of {}".format(codec, sorted(codecs)))
+    return codecs[codec]
+
+
+def check_level(codec, level):
+    """
+    :param codec: key of codecs
+    :param level: compression level, None for the codec's default
+    :return: None, raises ValueError if the codec doesn't take the level
+    """
+    codec_extension(codec)
+    if level is None:
+        return
+
+    if codec in ('png', 'tiles'):
+        if not 0 <= level <= 9:
+            raise ValueError("Compression level of {} must be 0-9, got {}".format(codec, level))
+    elif codec == 'npz':
+        if level != 0:
+            raise ValueError("npz only takes level 0 for uncompressed, got {}".format(level))
+    else:
+        raise ValueError("Codec {} has no compression level".format(codec))
+
+
+def write_npz(path, level=None, **arrays):
+    """
+    :param path: output .npz path
+    :param level: 0 stores the arrays uncompressed, None compresses them
+    :param arrays: arrays by key
+    :return: None
+    """
+    check_level('npz', level)
+    with open(path, 'wb') as f:
+        if level == 0:
+            np.savez(f, **arrays)
+        else:
+            np.savez_compressed(f, **arrays)
+
+
+def write_image(path, im, codec='tiff', level=None):
+    """
+    :param path: output path, its extension should be codec_extension(codec)
+    :param im: 2d uint8, uint16 or boolean image
+    :param codec: key of codecs
+    :param level: compression level for png, npz and tiles, None for the default, see check_level
+    :return: None
+    """
+    check_level(codec, level)
+
+    with stats.time('write', im.nbytes):
+        if codec == 'npz':
+            write_npz(path, level, image=im)
+        elif codec == 'tiles':
+            write_tiled(path, im, compress_level=1 if level is None else level)
+        elif codec == 'png':
+            Image.fromarray(im).save(path, 'png', compress_level=6 if level is None else level)
+        elif codec == 'tiff':
+            Image.fromarray(im).save(path, 'tiff')
+        else:
+            Image.fromarray(im).save(path, 'tiff', compression=codec)
+
+
+def read_image(path):
+    """
+    :param path: image written by write_image, or a mask written by
+                 ddsm_abnormality.save_mask, codec is taken from the extension
+    :return: image array, 16 bit images come back as uint16, .npz masks full size
+    """
+    if path.endswith('.npz'):
+        with np.load(path) as data:
+            if 'image' in data:
+                return data['image']
+            if 'mask' not in data:
+                raise ValueError("{} has neither an image nor a mask".format(path))
+
+            # bounding box of the mask, see ddsm_classes.load_mask
+            mask, (row, col) = data['mask'], data['offset']
+            im = np.zeros(tuple(data['shape']), dtype=bool)
+            im[row:row + mask.shape[0], col:col + mask.shape[1]] = mask
+            return im
+    if path.endswith('.tiles'):
+        with tiled_image(path) as im:
+            return im.read_level(0)
+
+    im = Image.open(path)
+    arr = np.array(im)
+    if im.mode in ('I', 'I;16'):  # 16 bit pngs open as 32 bit
+        arr = arr.astype(np.uint16)
+    return arr
+
+
+####################################################
+# Parallel encoding
+####################################################
+class image_writer(object):
+    """
+    Encodes and writes images on a pool of threads, so compressing one
+    image overlaps with decoding and converting the next. zlib and PIL's
+    encoders release the GIL while they work.
+    """
+
+    def __init__(self, jobs=2, max_pending=None):
+        """
+        :param jobs: number of encoding threads
+        :param max_pending: images queued before submit waits, defaults to 2 * jobs
+        """
+        self.max_pending = max_pending or 2 * jobs
+        self._pool = ThreadPool(jobs)
+        self._pending = deque()
+
+    def submit(self, path, im, codec='tiff', level=None):
+        """
+        Queue an image to be written, see write_image. im must not change until wait returns.
+        :return: None
+        """
+        while len(self._pending) >= self.max_pending:
+            self._pending.popleft().get()
+        self._pending.append(self._pool.apply_async(write_image, (path, im, codec, level)))
+
+    def wait(self):
+        """
+        Wait for every queued image, re-raising the first error
+        :return: None
+        """
+        while self._pending:
+            self._pending.popleft().get()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self._pool.close()
+            self._pool.join()
@@ -0,0 +1,164 @@
+import json
+import os
+
+import numpy as np
+
+from lmdb_writer import encode_blob
+
+
+####################################################
+# Running image statistics
+####################################################
+class image_stats(object):
+    """
+    Per-pixel mean and variance images and global intensity statistics of a
+    stream of uint8 images, accumulated without keeping the images.
+    Everything is kept as exact integer sums, so partial statistics from
+    different processes or machines merge, in any order, into exactly the
+    statistics of all their images.
+    """
+
+    def __init__(self, per_pixel=True):
+        """
+        :param per_pixel: keep mean and variance images, needs every image to be the same shape
+        """
+        self.per_pixel = per_pixel
+
+        # images added, with or without per_pixel
+        self.count = 0
+
+        # per-pixel sums over images
+        self.sum = None
+        self.sum_sq = None
+
+        # every pixel of every image
+        self.min = None
+        self.max = None
+        self.histogram = np.zeros(256, dtype=np.int64)
+
+    def add(self, im):
+        """
+        :param im: uint8 image
+        :return: None
+        """
+        if self.per_pixel:
+            wide = im.astype(np.int64)
+            self._merge_pixels(wide, np.square(wide))
+
+        self.count += 1
+        self._merge_global(im.min(), im.max(), np.bincount(im.ravel(), minlength=256))
+
+    def merge(self, other):
+        """
+        Add the images counted by other
+        :param other: image_stats
+        :return: self
+        """
+        if self.per_pixel and other.count:
+            if other.sum is None:
+                raise ValueError("Can't merge statistics without per-pixel sums into per-pixel ones")
+            self._merge_pixels(other.sum, other.sum_sq)
+
+        self.count += other.count
+        if other.pixels:
+            self._merge_global(other.min, other.max, other.histogram)
+        return self
+
+    def _merge_global(self, lo, hi, histogram):
+        self.min = lo if self.min is None else min(self.min, lo)
+        self.max = hi if self.max is None else max(self.max, hi)
+        self.histogram += histogram
+
+    def _merge_pixels(self, im_sum, im_sum_sq):
+        if self.sum is None:
+            self.sum = np.zeros(im_sum.shape, dtype=np.int64)
+            self.sum_sq = np.zeros(im_sum.shape, dtype=np.int64)
+        elif self.sum.shape != im_sum.shape:
+            raise ValueError("Image shape {} doesn't match {}".format(im_sum.shape, self.sum.shape))
+        self.sum += im_sum
+        self.sum_sq += im_sum_sq
+
+    @property
+    def pixels(self):
+        return int(self.histogram.sum())
+
+    @property
+    def mean(self):
+        """
+        :return: per-pixel mean image
+        """
+        return self.sum / float(self.count)
+
+    def variance(self):
+        """
+        :return: per-pixel population variance image
+        """
+        return (self.count * self.sum_sq - np.square(self.sum)) / float(self.count) ** 2
+
+    def save_partial(self, path):
+        """
+        Write the sums, for load_partial on another process or machine
+        :param path: .npz file
+        :return: None
+        """
+        arrays = {'per_pixel': self.per_pixel, 'count': self.count, 'histogram': self.histogram}
+        if self.min is not None:
+            arrays.update(min=self.min, max=self.max)
+        if self.sum is not None:
+            arrays.update(sum=self.sum, sum_sq=self.sum_sq)
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load_partial(cls, path):
+        """
+        :param path: .npz file written by save_partial
+        :return: image_stats
+        """
+        with np.load(path) as data:
+            stats = cls(per_pixel=bool(data['per_pixel']))
+            stats.count = int(data['count'])
+            stats.histogram = data['histogram']
+            if 'min' in data.files:
+                stats.min, stats.max = data['min'][()], data['max'][()]
+            if 'sum' in data.files:
+                stats.sum, stats.sum_sq = data['sum'], data['sum_sq']
+        return stats
+
+    def summary(self):
+        """
+        :return: dictionary of global intensity statistics
+        """
+        # exact sums over every pixel from the histogram
+        levels = np.arange(256, dtype=np.int64)
+        pixels = self.pixels
+        pixel_sum = int((self.histogram * levels).sum())
+        pixel_sum_sq = int((self.histogram * levels ** 2).sum())
+
+        return {
+            'images': self.count,
+            'pixels': pixels,
+            'mean': pixel_sum / float(pixels) if pixels else 0.0,
+            'std': float(np.sqrt((pixels * pixel_sum_sq - pixel_sum ** 2) / float(pixels) ** 2)) if pixels else None,
+            'min': None if self.min is None else int(self.min),
+            'max': None if self.max is None else int(self.max),
+            'histogram': self.histogram.tolist()
+        }
+
+    def save(self, out_dir, name):
+        """
+        Write {name}_mean and {name}_var as caffe .binaryproto and .npy, and the
+        global statistics as {name}_stats.json
+        :param out_dir: output directory
+        :param name: prefix of the files
+        :return: None
+        """
+        if self.per_pixel and self.count:
+            for kind, arr in [('mean', self.mean), ('var', self.variance())]:
+                path = os.path.join(out_dir, '{}_{}'.format(name, kind))
+                np.save(path + '.npy', arr)
+                with open(path + '.binaryproto', 'wb') as f:
+                    f.write(encode_blob(arr))
+
+        with open(os.path.join(out_dir, '{}_stats.json'.format(name)), 'w') as f:
+            json.dump(self.summary(), f)
@@ -0,0 +1,194 @@
+import cProfile
+import os
+import signal
+import time
+from collections import Counter
+from contextlib import contextmanager
+from threading import Lock
+
+
+####################################################
+# Stage counters
+####################################################
+# stages of the corpus build, in pipeline order
+stage_names = ['walk', 'prefetch', 'ics_parse', 'overlay_parse', 'chain_decode', 'ljpeg_decode',
+               'raw_read', 'od', 'crop', 'resize', 'mask', 'write']
+
+
+class stage_stats(object):
+    """
+    Calls, wall time and bytes for each stage of the build. Stages are timed
+    exclusively, nothing is counted under two stages. Worker processes send
+    the difference of two snapshots to the parent, which merges them.
+    """
+
+    def __init__(self):
+        self._stages = {}
+        self._lock = Lock()
+
+    @contextmanager
+    def time(self, stage, nbytes=0):
+        """
+        Time the body of a with statement under stage
+        :param stage: stage name
+        :param nbytes: bytes the stage handles
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start, nbytes)
+
+    def add(self, stage, seconds, nbytes=0, calls=1):
+        with self._lock:
+            counts = self._stages.setdefault(stage, [0, 0.0, 0])
+            counts[0] += calls
+            counts[1] += seconds
+            counts[2] += nbytes
+
+    def snapshot(self):
+        """
+        :return: dictionary of stage -> [calls, seconds, bytes]
+        """
+        with self._lock:
+            return dict((k, list(v)) for k, v in self._stages.items())
+
+    @staticmethod
+    def difference(after, before):
+        """
+        :param after: later snapshot
+        :param before: earlier snapshot
+        :return: snapshot of what happened in between
+        """
+        diff = {}
+        for stage, counts in after.items():
+            old = before.get(stage, [0, 0.0, 0])
+            if counts != old:
+                diff[stage] = [c - o for c, o in zip(counts, old)]
+        return diff
+
+    def merge(self, snapshot):
+        """
+        :param snapshot: snapshot or difference from another stage_stats
+        :return: None
+        """
+        for stage, (calls, seconds, nbytes) in snapshot.items():
+            self.add(stage, seconds, nbytes, calls)
+
+    def bytes(self, *stages):
+        with self._lock:
+            return sum(self._stages[s][2] for s in stages if s in self._stages)
+
+    def summary(self):
+        """
+        :return: dictionary of stage -> calls, seconds, bytes and MB/s, in pipeline order
+        """
+        snapshot = self.snapshot()
+        order = stage_names + sorted(s for s in snapshot if s not in stage_names)
+        summary = []
+        for stage in order:
+            if stage not in snapshot:
+                continue
+            calls, seconds, nbytes = snapshot[stage]
+            summary.append((stage, {
+                'calls': calls,
+                'seconds': seconds,
+                'bytes': nbytes,
+                'mb_per_second': nbytes / 1024.0 ** 2 / seconds if seconds and nbytes else None
+            }))
+        return summary
+
+
+# shared by everything in this process
+stats = stage_stats()
+
+
+def format_eta(seconds):
+    """
+    :param seconds: seconds left, None if unknown
+    :return: h:mm:ss
+    """
+    if seconds is None:
+        return '?'
+    minutes, secs = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, secs)
+
+
+####################################################
+# Worker profiling
+####################################################
+class sampling_profiler(object):
+    """
+    Statistical profiler that records the stack every interval seconds of
+    cpu time, with much less overhead than cProfile. Only works in the main
+    thread of a process, which is where Pool workers run their tasks.
+    dump_stats writes collapsed stacks, one 'frame;frame;frame count' line
+    per stack, the input format of flamegraph.pl.
+    """
+
+    def __init__(self, interval=0.005):
+        """
+        :param interval: cpu seconds between samples
+        """
+        self.interval = interval
+        self.counts = Counter()
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{}:{}:{}'.format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+            frame = frame.f_back
+        self.counts[';'.join(reversed(stack))] += 1
+
+    def enable(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.siginterrupt(signal.SIGPROF, False)  # restart system calls a sample lands in
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def disable(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+
+    def dump_stats(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.counts.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+
+# profiler kind -> (factory, file extension)
+profilers = {
+    'cprofile': (cProfile.Profile, 'prof'),
+    'sampling': (sampling_profiler, 'txt')
+}
+
+# profiler of this process, created by the first profiled task
+_profiler = {}
+
+
+@contextmanager
+def profiled(kind, profile_dir):
+    """
+    Profile the body of a with statement, adding to this process's profile,
+    which is written to profile_dir/{kind}_{pid}.{prof|txt} after each body.
+    cprofile files load with pstats, sampling files are collapsed stacks.
+    :param kind: key of profilers, None to not profile
+    :param profile_dir: directory for the profiles
+    """
+    if kind is None:
+        yield
+        return
+
+    if kind not in profilers:
+        raise ValueError("Unknown profiler {}, expected one of {}".format(kind, sorted(profilers)))
+    factory, ext = profilers[kind]
+    profiler = _profiler.get(kind)
+    if profiler is None:
+        profiler = _profiler[kind] = factory()
+
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(profile_dir, '{}_{}.{}'.format(kind, os.getpid(), ext)))
@@ -0,0 +1,451 @@
+import os
+import numpy as np
+
+
+####################################################
+# In-process lossless JPEG (ITU T.81 process 14) decoder
+####################################################
+# DDSM images are single component lossless JPEG streams written by the
+# PVRG codec in jpegdir/. Decoding them here avoids forking jpegdir/jpeg
+# and the round trip through a .LJPEG.1 file on disk.
+
+# bundled PVRG codec, used as the reference/fallback decoder
+jpeg_binary = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jpegdir', 'jpeg')
+
+# bits of entropy coded data per lane when decoding lanes side by side
+_lane_bits = 1 << 13
+
+# samples whose differences are extracted at once, bounds the int32 temporaries
+_band_samples = 1 << 20
+
+# start of frame markers for processes other than lossless huffman
+_unsupported_sof = [0xC0, 0xC1, 0xC2, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF]
+
+
+def read_ljpeg(ljpeg_path):
+    """
+    Decode a lossless jpeg file into memory
+    :param ljpeg_path: path to .LJPEG file
+    :return: uint16 numpy array of shape (height, width)
+    """
+    with open(ljpeg_path, 'rb') as f:
+        data = f.read()
+
+    return decode_ljpeg(data)
+
+
+def decode_ljpeg(data):
+    """
+    Decode a lossless jpeg stream
+    :param data: string of encoded bytes
+    :return: uint16 numpy array of shape (height, width)
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    header = _parse_header(buf)
+
+    height, width = header['height'], header['width']
+    restart = header['restart_interval']
+    if restart and restart % width != 0:
+        raise ValueError("Restart interval {} is not a whole number of rows".format(restart))
+
+    # restart markers realign the entropy coded data on a byte boundary.
+    # the PVRG codec starts every row with the same prediction, so
+    # restarts at row boundaries do not change the reconstruction.
+    segments = _entropy_segments(buf, header['scan_start'])
+    samples = restart if restart else height * width
+    if len(segments) != -(-height * width // samples):
+        raise ValueError("Found {} entropy coded segments for {} rows".format(len(segments), height))
+
+    # every sample takes at least one bit, so a corrupt frame size is caught
+    # before anything that size is allocated
+    if sum(len(segment) for segment in segments) * 8 < height * width:
+        raise ValueError("Entropy coded data is too short for {}x{} samples".format(height, width))
+
+    diffs = np.empty(height * width, dtype=np.uint16)
+    for idx, segment in enumerate(segments):
+        _decode_differences(segment, header['huffman_table'], diffs[idx * samples:(idx + 1) * samples])
+
+    return _reconstruct(diffs.reshape(height, width),
+                        header['predictor'],
+                        header['precision'],
+                        header['point_transform'])
+
+
+####################################################
+# Marker parsing
+####################################################
+def _parse_header(buf):
+    """
+    Read markers up to the start of scan
+    :param buf: uint8 array of the whole file
+    :return: dictionary of frame and scan parameters
+    """
+    if len(buf) < 4 or buf[0] != 0xFF or buf[1] != 0xD8:
+        raise ValueError("Missing JPEG start of image marker")
+
+    header = {'restart_interval': 0}
+    tables = {}
+    pos = 2
+    while pos + 4 <= len(buf):
+        if buf[pos] != 0xFF:
+            raise ValueError("Expected marker at byte {}".format(pos))
+        marker = buf[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+
+        length = (int(buf[pos + 2]) << 8) | int(buf[pos + 3])
+        if length < 2 or pos + 2 + length > len(buf):
+            raise ValueError("Marker segment 0x{:X} at byte {} is truncated".format(marker, pos))
+        seg = buf[pos + 4:pos + 2 + length]
+
+        if marker == 0xC3:
+            if len(seg) < 6 or len(seg) < 6 + 3 * int(seg[5]):
+                raise ValueError("Lossless start of frame is truncated")
+            if seg[5] != 1:
+                raise ValueError("Only single component images are supported")
+            header['precision'] = int(seg[0])
+            header['height'] = (int(seg[1]) << 8) | int(seg[2])
+            header['width'] = (int(seg[3]) << 8) | int(seg[4])
+            if not 2 <= header['precision'] <= 16 or not header['height'] or not header['width']:
+                raise ValueError("Unsupported frame of {}x{} samples with precision {}".format(
+                    header['height'], header['width'], header['precision']))
+        elif marker in _unsupported_sof:
+            raise ValueError("Not a lossless JPEG (SOF marker 0x{:X})".format(marker))
+        elif marker == 0xC4:
+            i = 0
+            while i < len(seg):
+                if i + 17 > len(seg):
+                    raise ValueError("Huffman table is truncated")
+                table_id = int(seg[i]) & 0x0F
+                if table_id > 3:
+                    raise ValueError("Huffman table id {} is out of range".format(table_id))
+                counts = seg[i + 1:i + 17].astype(np.int64)
+                if i + 17 + counts.sum() > len(seg):
+                    raise ValueError("Huffman table is truncated")
+                symbols = seg[i + 17:i + 17 + counts.sum()]
+                tables[table_id] = _build_huffman_lut(counts, symbols)
+                i += 17 + counts.sum()
+        elif marker == 0xDD:
+            if len(seg) < 2:
+                raise ValueError("Restart interval definition is truncated")
+            header['restart_interval'] = (int(seg[0]) << 8) | int(seg[1])
+        elif marker == 0xDA:
+            if len(seg) < 1 or len(seg) < 4 + 2 * int(seg[0]):
+                raise ValueError("Start of scan is truncated")
+            if seg[0] != 1:
+                raise ValueError("Only single component scans are supported")
+            if 'height' not in header:
+                raise ValueError("Start of scan before lossless start of frame")
+            table_id = int(seg[2]) >> 4
+            if table_id not in tables:
+                raise ValueError("Start of scan uses undefined huffman table {}".format(table_id))
+            header['huffman_table'] = tables[table_id]
+            header['predictor'] = int(seg[3])
+            header['point_transform'] = int(seg[5]) & 0x0F
+            if header['point_transform'] >= header['precision']:
+                raise ValueError("Point transform {} is not below the precision {}".format(
+                    header['point_transform'], header['precision']))
+            header['scan_start'] = pos + 2 + length
+            return header
+
+        pos += 2 + length
+
+    raise ValueError("No start of scan marker found")
+
+
+def _build_huffman_lut(counts, symbols):
+    """
+    Expand a huffman table into lookups on the next 16 bits of the stream
+    :param counts: number of codes of each length 1..16
+    :param symbols: symbols in order of increasing code length
+    :return: (code_length, symbol) uint8 arrays with 65536 entries
+    """
+    code_length = np.zeros(1 << 16, dtype=np.uint8)
+    code_symbol = np.zeros(1 << 16, dtype=np.uint8)
+
+    code = 0
+    k = 0
+    for length in range(1, 17):
+        for _ in range(counts[length - 1]):
+            if code >= 1 << length:
+                raise ValueError("Huffman table has more codes than fit in {} bits".format(length))
+            shift = 16 - length
+            code_length[code << shift:(code + 1) << shift] = length
+            code_symbol[code << shift:(code + 1) << shift] = symbols[k]
+            code += 1
+            k += 1
+        code <<= 1
+
+    return code_length, code_symbol
+
+
+def _entropy_segments(buf, start):
+    """
+    Split entropy coded data at restart markers and remove stuffed bytes
+    :param buf: uint8 array of the whole file
+    :param start: index of first byte after the start of scan header
+    :return: list of uint8 arrays
+    """
+    data = buf[start:]
+    ff = np.flatnonzero(data[:-1] == 0xFF)
+    following = data[ff + 1]
+
+    # marker bytes that are neither stuffing, fill nor restarts end the scan
+    is_restart = (following >= 0xD0) & (following <= 0xD7)
+    is_end = (following != 0x00) & (following != 0xFF) & ~is_restart
+    end = ff[is_end][0] if is_end.any() else len(data)
+
+    bounds = [0]
+    for r in ff[is_restart & (ff < end)]:
+        bounds.extend([r, r + 2])
+    bounds.append(end)
+
+    segments = []
+    for lo, hi in zip(bounds[::2], bounds[1::2]):
+        seg = data[lo:hi]
+        stuffed = np.flatnonzero((seg[:-1] == 0xFF) & (seg[1:] == 0x00)) + 1
+        segments.append(np.delete(seg, stuffed))
+    return segments
+
+
+####################################################
+# Huffman decoding
+####################################################
+def _windows(segment):
+    """
+    24 bit words starting at every byte, enough to read 16 bits at any bit offset
+    :param segment: uint8 array with byte stuffing removed
+    :return: int32 array with one word per byte of segment
+    """
+    buf = np.concatenate([segment, np.zeros(2, dtype=np.uint8)]).astype(np.int32)
+    return (buf[:-2] << 16) | (buf[1:-1] << 8) | buf[2:]
+
+
+def _peek16(words, pos):
+    """
+    Read the 16 bits starting at each bit position
+    :param words: output of _windows
+    :param pos: integer array of bit positions
+    :return: int32 array of values
+    """
+    return (words[pos >> 3] >> (8 - (pos & 7))) & 0xFFFF
+
+
+def _walk_lanes(words, step_lut, begin, end, sentinel):
+    """
+    Follow codes in many stretches of the stream at once
+    :param words: output of _windows
+    :param step_lut: bits taken by the code starting with each 16 bit value
+    :param begin: bit position each lane starts decoding at
+    :param end: lanes stop at the first code starting at or after this position
+    :param sentinel: value recorded once a lane has stopped
+    :return: (int32 code positions of shape (codes, lanes), position each lane stopped at)
+    """
+    limit = len(words) * 8 - 1
+    cur = begin.copy()
+    active = cur < end
+    rows = []
+    while active.any():
+        rows.append(np.where(active, cur, sentinel))
+        step = step_lut[_peek16(words, np.minimum(cur, limit))]
+        cur = np.where(active, cur + step, cur)
+        active = cur < end
+
+    # filled row by row rather than stacked, so the rows and the matrix
+    # are never all held at once
+    positions = np.empty((len(rows), len(begin)), dtype=np.int32)
+    for idx in range(len(rows)):
+        positions[idx] = rows[idx]
+        rows[idx] = None
+    return positions, cur
+
+
+def _decode_differences(segment, table, out):
+    """
+    Decode difference values from a huffman coded segment
+    :param segment: uint8 array with byte stuffing removed
+    :param table: lookup tables from _build_huffman_lut
+    :param out: uint16 array with one element per sample of the segment,
+                receives the differences modulo 2^16
+    :return: None
+    """
+    code_length, code_symbol = table
+    count = len(out)
+
+    # bit positions are int32, far more than any DDSM image needs
+    total_bits = len(segment) * 8
+    if total_bits >= 1 << 30:
+        raise ValueError("Entropy coded segment of {} bytes is too long".format(len(segment)))
+
+    # bits taken by a code and its additional bits, invalid codes jump
+    # far enough to end a lane
+    step_lut = (code_length + np.where(code_symbol < 16, code_symbol, 0)).astype(np.int32)
+    step_lut[code_length == 0] = total_bits + 1
+
+    # the stream is cut into lanes decoded side by side. a lane that starts
+    # in the middle of a code decodes garbage until it falls into step with
+    # the real code boundaries, which huffman codes do within a few codes.
+    # a lane is right once the real boundary entering it (where the lane
+    # before it stopped) is one of its positions; lanes that never found it
+    # are decoded again from that boundary.
+    words = _windows(segment)
+    lanes = max(1, total_bits // _lane_bits)
+    begin = np.arange(lanes, dtype=np.int32) * _lane_bits
+    end = np.append(begin[1:], total_bits)
+    sentinel = total_bits + 1
+
+    positions, exits = _walk_lanes(words, step_lut, begin, end, sentinel)
+    entry = begin.copy()
+    while True:
+        entry[1:] = exits[:-1]
+        found = (positions == entry).any(axis=0) | (entry >= end)
+        redo = np.flatnonzero(~found)
+        if not len(redo):
+            break
+
+        redo_positions, exits[redo] = _walk_lanes(words, step_lut, entry[redo], end[redo], sentinel)
+        rows = max(len(positions), len(redo_positions))
+        if rows > len(positions):
+            pad = np.full((rows - len(positions), lanes), sentinel, dtype=np.int32)
+            positions = np.vstack([positions, pad])
+        positions[:, redo] = sentinel
+        positions[:len(redo_positions), redo] = redo_positions
+
+    # code positions in stream order are the positions after each lane's entry
+    positions = positions.T
+    starts = positions[(positions >= entry[:, None]) & (positions != sentinel)]
+    del positions
+    if len(starts) < count:
+        raise ValueError("Entropy coded data ended after {} of {} samples".format(len(starts), count))
+
+    for lo in range(0, count, _band_samples):
+        band = starts[lo:min(lo + _band_samples, count)]
+        window = _peek16(words, band)
+        lengths = code_length[window].astype(np.int32)
+        if (lengths == 0).any():
+            raise ValueError("Invalid huffman code in entropy coded data")
+        ssss = code_symbol[window].astype(np.int32)
+
+        # additional bits follow the code, extend them to signed differences
+        bits = np.where(ssss < 16, ssss, 0)
+        # a corrupt stream can run its last code off the end, read zeros there
+        value = _peek16(words, np.minimum(band + lengths, len(words) * 8 - 1)) >> (16 - bits)
+        diffs = np.where(value < (1 << bits) >> 1, value - (1 << bits) + 1, value)
+        diffs[ssss == 0] = 0
+        diffs[ssss == 16] = 32768
+        out[lo:lo + len(band)] = diffs & 0xFFFF
+
+
+####################################################
+# Prediction
+####################################################
+def _reconstruct(diffs, predictor, precision, point_transform):
+    """
+    Undo lossless prediction the way the PVRG codec does it: the row above
+    the first row is treated as filled with 2^(precision - point_transform - 1)
+    and the first column of every row is predicted from above. The codec
+    keeps samples modulo 2^16, so the arithmetic is done in uint16, in place.
+    :param diffs: (rows, cols) uint16 array of decoded differences modulo 2^16,
+                  overwritten with the samples
+    :param predictor: selection value 1-7
+    :param precision: sample precision in bits
+    :param point_transform: point transform shift
+    :return: (rows, cols) uint16 array
+    """
+    rows, cols = diffs.shape
+    default = 1 << (precision - point_transform - 1)
+
+    x = diffs
+    first = np.cumsum(x[:, 0], dtype=np.uint16)
+    first += default
+
+    if predictor == 1:  # Ra
+        x[:, 0] = first
+        np.cumsum(x, axis=1, dtype=np.uint16, out=x)
+    elif predictor == 2:  # Rb
+        np.cumsum(x[:, 1:], axis=0, dtype=np.uint16, out=x[:, 1:])
+        x[:, 1:] += default
+        x[:, 0] = first
+    elif 3 <= predictor <= 5:
+        prev = np.full(cols, default, dtype=np.uint16)
+        for r in range(rows):
+            d = x[r, 1:]
+            if predictor == 3:  # Rc
+                x[r, 1:] = prev[:-1] + d
+            elif predictor == 4:  # Ra + Rb - Rc
+                x[r, 1:] = first[r] + np.cumsum(np.diff(prev) + d, dtype=np.uint16)
+            else:  # Ra + ((Rb - Rc) >> 1)
+                step = (np.diff(prev.astype(np.int32)) >> 1) + d
+                x[r, 1:] = first[r] + (np.cumsum(step) & 0xFFFF).astype(np.uint16)
+            x[r, 0] = first[r]
+            prev = x[r]
+    elif 6 <= predictor <= 7:
+        _reconstruct_wavefront(x, first, predictor, default)
+    else:
+        raise ValueError("Unsupported lossless predictor {}".format(predictor))
+
+    if point_transform:
+        x <<= point_transform
+    return x
+
+
+
+def _reconstruct_wavefront(x, first, predictor, default):
+    """
+    Predictors 6 and 7 depend on the left sample non-linearly, so a row can't
+    be reconstructed with a cumulative sum. A sample only depends on its left,
+    upper and upper left neighbours though, so every anti-diagonal is
+    reconstructed at once from the two before it. With the row above the image
+    added, the samples of an anti-diagonal are every cols - 1 samples of the
+    flattened image and their neighbours are slices of it too.
+    :param x: (rows, cols) uint16 array of differences, overwritten with the samples
+    :param first: uint16 samples of the first column
+    :param predictor: selection value 6 or 7
+    :param default: value of the row above the first row
+    :return: None
+    """
+    rows, cols = x.shape
+    x[:, 0] = first
+    if cols < 2:
+        return
+
+    padded = np.empty((rows + 1, cols), dtype=np.uint16)
+    padded[0] = default
+    padded[1:] = x
+    flat = padded.ravel()
+
+    step = cols - 1
+    for diagonal in range(2, rows + cols):
+        # rows 1..rows and columns 1..cols-1 of padded on this anti-diagonal
+        lo = diagonal + max(1, diagonal - step) * step
+        hi = diagonal + min(rows, diagonal - 1) * step + 1
+        left = flat[lo - 1:hi - 1:step].astype(np.int32)
+        above = flat[lo - cols:hi - cols:step].astype(np.int32)
+        if predictor == 6:  # Rb + ((Ra - Rc) >> 1)
+            above += (left - flat[lo - cols - 1:hi - cols - 1:step]) >> 1
+        else:  # (Ra + Rb) >> 1
+            above += left
+            above >>= 1
+        above += flat[lo:hi:step]
+        flat[lo:hi:step] = above & 0xFFFF
+
+    x[...] = padded[1:]
+
+####################################################
+# Reference decoder
+####################################################
+def verify_ljpeg(ljpeg_path, raw_path=None):
+    """
+    Check the in-process decoder against a decompressed .LJPEG.1 file
+    written by jpegdir/jpeg
+    :param ljpeg_path: path to .LJPEG file
+    :param raw_path: path to the decompressed file, defaults to ljpeg_path + '.1'
+    :return: True if both decodes are bit-exact
+    """
+    if raw_path is None:
+        raw_path = ljpeg_path + '.1'
+
+    im = read_ljpeg(ljpeg_path)
+    ref = np.fromfile(raw_path, dtype='>u2')
+    return ref.size == im.size and np.array_equal(ref.reshape(im.shape), im)
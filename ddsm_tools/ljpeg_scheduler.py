@@ -0,0 +1,192 @@
+import os
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from subprocess import Popen, PIPE, STDOUT
+from threading import Condition, Thread
+
+from instrumentation import stats
+from ljpeg import jpeg_binary
+
+
+####################################################
+# Decompression with the bundled codec
+####################################################
+def decompress_ljpeg(ljpeg_path, out_dir=None, expected_size=None):
+    """
+    Decompress an LJPEG with jpegdir/jpeg. The codec writes its output next to
+    its input, so for another directory it's run on a symlink to the LJPEG.
+    :param ljpeg_path: path to .LJPEG file
+    :param out_dir: directory for the .LJPEG.1 file, None writes it next to the LJPEG
+    :param expected_size: bytes the .LJPEG.1 file should have, None to not check
+    :return: (path of the .LJPEG.1 file, output of the codec)
+    """
+    target = ljpeg_path
+    if out_dir is not None:
+        target = os.path.join(out_dir, os.path.basename(ljpeg_path))
+    raw_path = target + '.1'
+
+    # left by an earlier run
+    if os.path.exists(raw_path) and expected_size is not None and os.path.getsize(raw_path) == expected_size:
+        return raw_path, ''
+
+    if target != ljpeg_path and not os.path.lexists(target):
+        os.symlink(os.path.abspath(ljpeg_path), target)
+    try:
+        proc = Popen([jpeg_binary, '-d', '-s', target], stdout=PIPE, stderr=STDOUT)
+        output = proc.communicate()[0]
+    finally:
+        if target != ljpeg_path and os.path.lexists(target):
+            os.remove(target)
+
+    if proc.returncode != 0 or not os.path.exists(raw_path) or \
+            (expected_size is not None and os.path.getsize(raw_path) != expected_size):
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+        raise ValueError("Decompressing {} failed with exit status {}:\n{}".format(
+            ljpeg_path, proc.returncode, output))
+    return raw_path, output
+
+
+####################################################
+# Scheduler
+####################################################
+class ljpeg_scheduler(object):
+    """
+    Decompresses LJPEGs ahead of the code reading them, on a pool of threads
+    each running one jpegdir/jpeg process, in the order they were scheduled.
+    Rasters are written to a scratch directory rather than the source tree.
+    At most budget bytes of them exist at once, decompression waits until
+    the reader releases rasters it's finished with, which deletes them.
+    LJPEGs are scheduled in groups that are read together, e.g. the views of
+    a case, and room is made for a whole group before any of it starts.
+    Failed files are retried, and the output of their last try is kept in
+    failures.
+    """
+
+    def __init__(self, scratch_dir, jobs=2, budget=None, retries=2, stage_counts=None):
+        """
+        :param scratch_dir: directory for the .LJPEG.1 files, created if needed
+        :param jobs: number of codec processes running at once
+        :param budget: bytes of rasters allowed in scratch_dir, None for no limit.
+                       One group is always allowed, however large.
+        :param retries: number of times a failed file is tried again
+        :param stage_counts: stage_stats the decompression is recorded in, defaults to
+                             instrumentation.stats
+        """
+        if not os.path.exists(scratch_dir):
+            os.makedirs(scratch_dir)
+
+        self.scratch_dir = scratch_dir
+        self.budget = budget
+        self.retries = retries
+        self.stage_counts = stats if stage_counts is None else stage_counts
+
+        # ljpeg path -> output of the codec on its last try
+        self.failures = OrderedDict()
+
+        self._cond = Condition()
+        self._pool = ThreadPool(jobs)
+        self._dispatcher = None
+        self._closed = False
+        self._scheduled = set()
+        self._used = 0
+        self._sizes = {}  # ljpeg path -> bytes held in scratch_dir
+        self._done = {}  # ljpeg path -> raster path, None if it failed
+
+    def schedule(self, groups):
+        """
+        Start decompressing in the background
+        :param groups: lists of (ljpeg path, bytes of its raster), in the order they will be read
+        :return: None
+        """
+        groups = [list(group) for group in groups]
+        self._scheduled.update(path for group in groups for path, _ in group)
+        self._dispatcher = Thread(target=self._dispatch, args=(groups,))
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    def _dispatch(self, groups):
+        for group in groups:
+            group_bytes = sum(nbytes for _, nbytes in group)
+            with self._cond:
+                while not self._closed and self.budget is not None and \
+                        self._used and self._used + group_bytes > self.budget:
+                    self._cond.wait(1.0)
+                if self._closed:
+                    return
+                self._used += group_bytes
+                self._sizes.update(group)
+                # under the lock, so close can't close the pool in between
+                for ljpeg_path, nbytes in group:
+                    self._pool.apply_async(self._decompress, (ljpeg_path, nbytes))
+
+    def _decompress(self, ljpeg_path, nbytes):
+        raw_path = None
+        for _ in range(self.retries + 1):
+            if self._closed:
+                return
+            try:
+                with self.stage_counts.time('ljpeg_decode', nbytes):
+                    raw_path, _ = decompress_ljpeg(ljpeg_path, self.scratch_dir, nbytes)
+                break
+            except (OSError, ValueError) as e:
+                error = str(e)
+
+        with self._cond:
+            self._done[ljpeg_path] = raw_path
+            if raw_path is None:
+                self.failures[ljpeg_path] = error
+                self._used -= self._sizes.pop(ljpeg_path, 0)
+            self._cond.notify_all()
+
+    def ready(self, ljpeg_path):
+        """
+        :param ljpeg_path: .LJPEG path
+        :return: True if wait would return without waiting
+        """
+        with self._cond:
+            return ljpeg_path not in self._scheduled or ljpeg_path in self._done
+
+    def wait(self, ljpeg_path):
+        """
+        :param ljpeg_path: scheduled .LJPEG path
+        :return: path of its raster in scratch_dir, None if it failed or wasn't scheduled
+        """
+        if ljpeg_path not in self._scheduled:
+            return None
+        with self._cond:
+            while ljpeg_path not in self._done:
+                self._cond.wait(1.0)
+            return self._done[ljpeg_path]
+
+    def release(self, ljpeg_path):
+        """
+        Delete the raster of an LJPEG that has been read, making room for the next ones
+        :param ljpeg_path: scheduled .LJPEG path
+        :return: None
+        """
+        with self._cond:
+            raw_path = self._done.pop(ljpeg_path, None)
+            self._used -= self._sizes.pop(ljpeg_path, 0)
+            self._cond.notify_all()
+        if raw_path is not None and os.path.exists(raw_path):
+            os.remove(raw_path)
+
+    def close(self):
+        """
+        Stop decompressing and delete the rasters that haven't been released
+        :return: None
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._pool.close()
+        self._pool.join()
+        for ljpeg_path in list(self._done):
+            self.release(ljpeg_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,205 @@
+import numpy as np
+
+
+####################################################
+# Caffe protobuf messages
+####################################################
+# Datum and BlobProto are encoded by hand following caffe.proto, so
+# writing data sets doesn't need a caffe install
+#   Datum:     channels = 1, height = 2, width = 3, data = 4, label = 5
+#   BlobProto: num = 1, channels = 2, height = 3, width = 4, data = 5 (packed float)
+
+def _varint(n):
+    out = []
+    while True:
+        bits = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(chr(bits | 0x80))
+        else:
+            out.append(chr(bits))
+            return ''.join(out)
+
+
+def _read_varint(data, pos):
+    n, shift = 0, 0
+    while True:
+        b = ord(data[pos])
+        pos += 1
+        n |= (b & 0x7f) << shift
+        shift += 7
+        if not b & 0x80:
+            return n, pos
+
+
+def _field_varint(num, value):
+    return _varint(num << 3) + _varint(value)
+
+
+def _field_bytes(num, data):
+    return _varint((num << 3) | 2) + _varint(len(data)) + data
+
+
+def _fields(data):
+    """
+    :param data: serialized message
+    :return: list of (field number, value) with varints as ints and
+             length delimited fields as strings
+    """
+    fields = []
+    pos = 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        num, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _read_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = _read_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire_type == 5:
+            value = data[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported wire type {}".format(wire_type))
+        fields.append((num, value))
+    return fields
+
+
+def encode_datum(im, label=None):
+    """
+    :param im: uint8 image, (height, width) or (channels, height, width)
+    :param label: integer label, None to leave it out and add it later with datum_label
+    :return: serialized caffe Datum
+    """
+    if im.ndim == 2:
+        im = im[np.newaxis]
+    channels, height, width = im.shape
+    datum = (_field_varint(1, channels) +
+             _field_varint(2, height) +
+             _field_varint(3, width) +
+             _field_bytes(4, np.ascontiguousarray(im, dtype=np.uint8).tostring()))
+    if label is not None:
+        datum += datum_label(label)
+    return datum
+
+
+def datum_label(label):
+    """
+    Fields can come in any order, so appending this to a Datum without a label sets it
+    :param label: integer label
+    :return: serialized label field
+    """
+    return _field_varint(5, label)
+
+
+def decode_datum(data):
+    """
+    :param data: serialized caffe Datum with uint8 data
+    :return: ((channels, height, width) uint8 image, label)
+    """
+    values = dict(_fields(data))
+    im = np.frombuffer(values[4], dtype=np.uint8)
+    return im.reshape(values[1], values[2], values[3]), values.get(5, 0)
+
+
+def encode_blob(arr):
+    """
+    :param arr: (channels, height, width) or (height, width) array, e.g. a mean image
+    :return: serialized caffe BlobProto with num 1, as written by compute_image_mean
+    """
+    if arr.ndim == 2:
+        arr = arr[np.newaxis]
+    channels, height, width = arr.shape
+    return (_field_varint(1, 1) +
+            _field_varint(2, channels) +
+            _field_varint(3, height) +
+            _field_varint(4, width) +
+            _field_bytes(5, np.ascontiguousarray(arr, dtype='<f4').tostring()))
+
+
+def decode_blob(data):
+    """
+    :param data: serialized caffe BlobProto
+    :return: float32 (num, channels, height, width) array
+    """
+    values = _fields(data)
+    dims = dict(values)
+    floats = ''.join(v for n, v in values if n == 5)  # packed, or one float per field
+    arr = np.frombuffer(floats, dtype='<f4').astype(np.float32)
+    return arr.reshape(dims.get(1, 1), dims.get(2, 1), dims.get(3, 1), dims.get(4, 1))
+
+
+####################################################
+# Batched LMDB writes
+####################################################
+class lmdb_writer(object):
+    """
+    Writes records to an lmdb database, committing a transaction every
+    batch_size records rather than one per record. Needs the lmdb package.
+    """
+
+    def __init__(self, lmdb_path, batch_size=1000, map_size=1 << 40):
+        """
+        :param lmdb_path: directory of the database, created if needed
+        :param batch_size: records per transaction
+        :param map_size: maximum size of the database, only address space is reserved
+        """
+        import lmdb
+
+        self.lmdb_path = lmdb_path
+        self.batch_size = batch_size
+        self.count = 0
+
+        self._env = lmdb.open(lmdb_path, map_size=map_size)
+        self._txn = None
+        self._pending = 0
+
+    def put(self, key, value):
+        """
+        :param key: record key, caffe reads records in key order
+        :param value: serialized record
+        :return: None
+        """
+        if self._txn is None:
+            self._txn = self._env.begin(write=True)
+        self._txn.put(key, value)
+        self._pending += 1
+        self.count += 1
+        if self._pending >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        if self._txn is not None:
+            self._txn.commit()
+            self._txn = None
+            self._pending = 0
+
+    def close(self):
+        self.commit()
+        self._env.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None and self._txn is not None:
+            self._txn.abort()
+            self._txn = None
+        self.close()
+
+
+def iter_lmdb(lmdb_path):
+    """
+    :param lmdb_path: directory of a database
+    :return: generator of (key, value) in key order
+    """
+    import lmdb
+
+    env = lmdb.open(lmdb_path, readonly=True, lock=False)
+    try:
+        with env.begin() as txn:
+            for key, value in txn.cursor():
+                yield key, value
+    finally:
+        env.close()
@@ -1,8 +1,24 @@
+import argparse
 import csv
+import json
 import os
+import time
+import traceback
+from collections import OrderedDict, deque
+from itertools import groupby, izip
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
 
 from ddsm_util import get_ics_info, get_abnormality_data
-from ddsm_classes import ddsm_abnormality
+from ddsm_classes import ddsm_abnormality, ddsm_image
+from image_codecs import check_level, image_writer
+from image_cache import raw_image_cache
+from instrumentation import format_eta, profiled, stage_stats, stats
+from ljpeg_scheduler import ljpeg_scheduler
+from shards import in_shard, parse_shard, shard_suffix
+from build_manifest import build_manifest, case_inputs
 
 fields = ['patient_id',
           'breast_density',
@@ -32,22 +48,13 @@ fields = ['patient_id',
           'mask_path']
 
 
-def make_data_set(root, out_dir):
-    outfile = open(os.path.join(out_dir, 'ddsm_description_cases.csv'), 'w')
-    outfile_writer = csv.writer(outfile, delimiter=',')
-    outfile_writer.writerow(fields)
-
-    img_dir = os.path.join(out_dir, 'raw_images')
-    crop_dir = os.path.join(out_dir, 'cropped_images')
-    od_dir = os.path.join(out_dir, 'od_images')
-    od_crop_dir = os.path.join(out_dir, 'od_cropped_images')
-    mask_dir = os.path.join(out_dir, 'mask_images')
-
-    for dir_path in [img_dir, crop_dir, od_dir, od_crop_dir, mask_dir]:
-        if not os.path.exists(dir_path):
-            os.mkdir(dir_path)
-
-    count = 0
+def find_cases(root):
+    """
+    Walk the DDSM tree for case directories
+    :param root: root of the cases tree
+    :return: list of (ics_file_path, [overlay paths]) in walk order
+    """
+    cases = []
     for curdir, dirs, files in os.walk(root):
         overlays = []
         ics_file_path = None
@@ -61,52 +68,661 @@ def make_data_set(root, out_dir):
         if not ics_file_path:
             continue
 
+        cases.append((ics_file_path, overlays))
+    return cases
+
+
+def parse_case(case):
+    """
+    Parse the metadata of every abnormality in a case, without touching images
+    :param case: (ics_file_path, [overlay paths]) from find_cases
+    :return: list with a list of ddsm_abnormality objects for each view with abnormalities
+    """
+    ics_file_path, overlays = case
+    with stats.time('ics_parse', os.path.getsize(ics_file_path)):
         ics_dict = get_ics_info(ics_file_path)
-        for overlay_path in overlays:
 
+    views = []
+    for overlay_path in overlays:
+        with stats.time('overlay_parse', os.path.getsize(overlay_path)):
             abnormality_data = get_abnormality_data(overlay_path)
+        if not abnormality_data:
+            continue
 
-            for file_name, lesion_type, lesion_data in abnormality_data:
-                abnormality = ddsm_abnormality(file_name,
-                                               lesion_type,
-                                               lesion_data,
-                                               ics_dict)
+        # every abnormality in an overlay is on the same view
+        views.append([ddsm_abnormality(file_name, lesion_type, lesion_data, ics_dict)
+                      for file_name, lesion_type, lesion_data in abnormality_data])
+    return views
 
-                count += 1
-                if count % 100 == 0:
-                    print "abnormality {}".format(count)
 
-                try:
-                    # raw gray-level
-                    # abnormality.raw_img_path = abnormality.save_image(out_dir=img_dir)
+def _load_case(case, pixels=None):
+    """
+    Parse a case and read the pixels of each of its views
+    :param case: (ics_file_path, [overlay paths]) from find_cases
+    :param pixels: None, 'raw' or 'od', see iter_abnormalities
+    :return: list of (abnormalities, image or None, message or None) for each view
+    """
+    try:
+        parsed = parse_case(case)
+    except Exception:
+        return [([], None, "Error with case {}\n{}".format(case[0], traceback.format_exc()))]
 
-                    # raw gray-level crops
-                    # abnormality.raw_crop_path = abnormality.save_image(out_dir=crop_dir, crop=True)
+    views = []
+    for abnormalities in parsed:
+        im, message = None, None
+        if pixels is not None:
+            try:
+                handle = abnormalities[0].image
+                im = handle.od() if pixels == 'od' else handle.raw()
+                if isinstance(im, np.memmap):
+                    im = im.astype(np.uint16)  # read it now rather than when it's used
+            except ValueError:
+                message = "Error with abnormality at " + abnormalities[0].input_file_path
+        views.append((abnormalities, im, message))
+    return views
 
-                    # uint8 optical density
-                    abnormality.od_img_path = abnormality.save_image(out_dir=od_dir, od_correct=True)
 
-                    # uint8 optical density crops
-                    abnormality.od_crop_path = abnormality.save_image(out_dir=od_crop_dir,
-                                                                      od_correct=True,
-                                                                      crop=True)
-                    # resized od images
-                    # d = os.path.join(out_dir, 'od_resized_crops')
-                    # abnormality.save_image(out_dir=d, od_correct=True, crop=True, resize=(256, 256))
+def iter_abnormalities(root, pixels=None, prefetch=4):
+    """
+    Stream the abnormalities under root in find_cases order. The next cases are
+    parsed and read by a pool of background threads while the current one is
+    being used, at most prefetch cases ahead, so memory stays bounded.
+    :param root: root of the cases tree
+    :param pixels: None to yield only abnormalities, 'raw' to also yield the raw
+                   image of their view, 'od' for the uint8 optical density image
+    :param prefetch: number of cases to read ahead, 0 reads each case when it's reached
+    :return: generator of ddsm_abnormality, or (ddsm_abnormality, image) if pixels is set.
+             Cases that can't be parsed and views whose image can't be read
+             are reported and skipped.
+    """
+    if pixels not in (None, 'raw', 'od'):
+        raise ValueError("pixels must be None, 'raw' or 'od', not {}".format(pixels))
+
+    cases = iter(find_cases(root))
+    pool = ThreadPool(prefetch) if prefetch > 0 else None
+    pending = deque()
+    try:
+        while True:
+            # keep prefetch cases in flight
+            while pool is not None and len(pending) < prefetch:
+                case = next(cases, None)
+                if case is None:
+                    break
+                pending.append(pool.apply_async(_load_case, (case, pixels)))
+
+            if pool is not None:
+                if not pending:
+                    break
+                views = pending.popleft().get()
+            else:
+                case = next(cases, None)
+                if case is None:
+                    break
+                views = _load_case(case, pixels)
+
+            for abnormalities, im, message in views:
+                if message is not None:
+                    print message
+                    continue
+                for abnormality in abnormalities:
+                    yield abnormality if pixels is None else (abnormality, im)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def iter_views(root, abnormality_type=None):
+    """
+    Stream the abnormalities under root grouped by view, see iter_abnormalities
+    :param root: root of the cases tree
+    :param abnormality_type: only keep this type of abnormality, e.g. 'mass',
+                             views without any are skipped
+    :return: generator of lists of ddsm_abnormality objects, one list per view
+    """
+    abnormalities = (a for a in iter_abnormalities(root)
+                     if abnormality_type is None or a.abnormality_type == abnormality_type)
+    for _, view in groupby(abnormalities, key=lambda a: a.input_file_path):
+        yield list(view)
+
+
+# image_writer of this process for each number of encoding threads
+_writers = {}
+
+
+def process_case(case,
+                 out_dirs,
+                 crop_resize=None,
+                 compact_masks=False,
+                 tiled_images=False,
+                 codec='tiff',
+                 codec_level=None,
+                 encode_jobs=0,
+                 scratch_dir=None,
+                 decoder=None,
+                 force=False):
+    """
+    Write the images for every abnormality in a case
+    :param case: (ics_file_path, [overlay paths]) from find_cases
+    :param out_dirs: dictionary of output directories
+    :param crop_resize: (width, height) to resize od crops to, None keeps their size
+    :param compact_masks: save masks as bounding box .npz files instead of full size tiffs
+    :param tiled_images: save full od images as tiled images with downsampled levels, see tiled_image
+    :param codec: output codec of images and full size masks, see image_codecs
+    :param codec_level: compression level of the codec and of tiled images,
+                        None for their defaults, see image_codecs.check_level
+    :param encode_jobs: number of threads encoding images while the next view is
+                        decoded, 0 encodes each image before moving on
+    :param scratch_dir: directory decompressed LJPEGs are read from and written to
+                        instead of next to the LJPEGs, see ljpeg_scheduler. Those the
+                        case decompresses itself are deleted when it's done.
+    :param decoder: 'native' or 'subprocess' to decode the LJPEGs with, see
+                    ddsm_abnormality.ljpeg_decoder, None for its default
+    :param force: rewrite images that already exist
+    :return: (number of abnormalities, csv rows, messages to report)
+    """
+    count = 0
+    rows = []
+    messages = []
 
-                    abnormality.mask_path = abnormality.save_mask(out_dir=mask_dir)
+    writer = None
+    if encode_jobs > 0:
+        writer = _writers.get(encode_jobs)
+        if writer is None:
+            writer = _writers[encode_jobs] = image_writer(encode_jobs)
 
-                except ValueError:
-                    print "Error with abnormality at " + abnormality.input_file_path
+    od_img_codec = 'tiles' if tiled_images else codec
 
+    # outputs for every abnormality, see ddsm_image.render
+    plan = {
+        # raw gray-level
+        # 'raw_img_path': {'out_dir': out_dirs['img']},
+
+        # raw gray-level crops
+        # 'raw_crop_path': {'out_dir': out_dirs['crop'], 'crop': True},
+
+        # uint8 optical density
+        'od_img_path': {'out_dir': out_dirs['od'], 'od_correct': True,
+                        'codec': od_img_codec, 'level': codec_level},
+
+        # uint8 optical density crops
+        'od_crop_path': {'out_dir': out_dirs['od_crop'], 'od_correct': True, 'crop': True, 'resize': crop_resize,
+                         'codec': codec, 'level': codec_level},
+
+        'mask_path': {'out_dir': out_dirs['mask'], 'mask': True, 'compact': compact_masks,
+                      'codec': codec, 'level': codec_level}
+    }
+
+    # views of the case, dropped from raw_image_cache when it's done
+    views = []
+
+    # settings of ddsm_abnormality for this case, put back when it's done so
+    # they don't carry over to later calls in the process
+    defaults = ddsm_abnormality.scratch_dir, ddsm_abnormality.ljpeg_decoder
+    if scratch_dir is not None:
+        ddsm_abnormality.scratch_dir = scratch_dir
+    if decoder is not None:
+        ddsm_abnormality.ljpeg_decoder = decoder
+
+    try:
+        for abnormalities in parse_case(case):
+            count += len(abnormalities)
+            views.append(abnormalities[0].input_file_path)
+
+            try:
+                ddsm_image(abnormalities).render(plan, force=force, writer=writer)
+            except ValueError:
+                messages.append("Error with abnormality at " + abnormalities[0].input_file_path)
+
+            for abnormality in abnormalities:
                 try:
-                    outfile_writer.writerow([getattr(abnormality, f) for f in fields])
+                    rows.append([getattr(abnormality, f) for f in fields])
                 except AttributeError:
-                    print "Abnormality {} has no od image".format(abnormality.input_file_path)
+                    messages.append("Abnormality {} has no od image".format(abnormality.input_file_path))
+
+        # every file in rows is written before the case counts as done
+        if writer is not None:
+            writer.wait()
+    finally:
+        # no other case reads these views, and a cached memmap would keep
+        # a deleted scratch image on disk
+        for input_file_path in views:
+            raw_image_cache.discard(input_file_path)
+        ddsm_abnormality.remove_scratch_images()
+        ddsm_abnormality.scratch_dir, ddsm_abnormality.ljpeg_decoder = defaults
+
+    return count, rows, messages
+
+
+def _process_case_task(task):
+    """
+    Pool entry point, reports errors instead of raising so one bad
+    case doesn't stop the build
+    :param task: (case, out_dirs, dictionary of process_case options, force,
+                  (profiler kind or None, profile directory))
+    :return: (finished without error, number of abnormalities, csv rows, messages,
+              image cache counters, stage counters, see instrumentation.stage_stats)
+    """
+    case, out_dirs, options, force, (profile, profile_dir) = task
+    before = raw_image_cache.stats()
+    stages_before = stats.snapshot()
+    try:
+        with profiled(profile, profile_dir):
+            count, rows, messages = process_case(case, out_dirs, force=force, **options)
+        ok = True
+    except Exception:
+        ok, count, rows = False, 0, []
+        messages = ["Error with case {}\n{}".format(case[0], traceback.format_exc())]
+
+    after = raw_image_cache.stats()
+    cache_counts = dict((k, after[k] - before[k]) for k in ['hits', 'misses', 'evictions'])
+    stage_counts = stage_stats.difference(stats.snapshot(), stages_before)
+    return ok, count, rows, messages, cache_counts, stage_counts
+
+
+####################################################
+# Build pipeline
+####################################################
+def _case_ljpegs(case):
+    """
+    :param case: (ics_file_path, [overlay paths]) from find_cases
+    :return: .LJPEG paths of the views with overlays
+    """
+    return [overlay_path[:-1 * len('.OVERLAY')] + '.LJPEG' for overlay_path in case[1]]
+
+
+def _decompress_groups(cases):
+    """
+    :param cases: cases from find_cases
+    :return: for ljpeg_scheduler.schedule, a list for each case of (.LJPEG path,
+             bytes of its raster) for its LJPEGs without a decompressed image next to them
+    """
+    groups = []
+    for ics_file_path, overlays in cases:
+        try:
+            ics_dict = get_ics_info(ics_file_path)
+        except Exception:
+            continue  # the worker reports the case
+
+        group = []
+        for ljpeg_path in _case_ljpegs((ics_file_path, overlays)):
+            sequence = os.path.basename(ljpeg_path).split('.')[1]
+            if sequence in ics_dict and os.path.exists(ljpeg_path) and not os.path.exists(ljpeg_path + '.1'):
+                group.append((ljpeg_path, ics_dict[sequence]['height'] * ics_dict[sequence]['width'] * 2))
+        if group:
+            groups.append(group)
+    return groups
+
 
-    outfile.close()
+def _read_ahead(case, stage_counts, images=True, block_size=1 << 20):
+    """
+    Read every input file of a case through once, so the worker that builds
+    it finds them in the page cache instead of waiting on storage
+    :param case: (ics_file_path, [overlay paths]) from find_cases
+    :param stage_counts: stage_stats the read is recorded in as 'prefetch'
+    :param images: also read the images, not needed when they're being decompressed
+    :param block_size: bytes per read
+    :return: None
+    """
+    ics_file_path, overlays = case
+    paths = [ics_file_path] + list(overlays)
+    for image_path in _case_ljpegs(case) if images else []:
+        # the decompressed image is what gets read when there is one
+        paths.append(image_path + '.1' if os.path.exists(image_path + '.1') else image_path)
+
+    start = time.time()
+    nbytes = 0
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(block_size), ''):
+                    nbytes += len(block)
+        except IOError:
+            continue  # the worker reports missing files
+    stage_counts.add('prefetch', time.time() - start, nbytes)
+
+
+def _pipeline(tasks, stage_counts, jobs=1, read_jobs=1, queue_depth=None, scheduler=None):
+    """
+    Run _process_case_task over tasks as overlapping stages: reader threads pull
+    the next cases' files from storage, worker processes decode and convert them,
+    and each worker's image_writer threads encode and write the outputs. Each
+    stage waits when it gets too far ahead of the next, so storage and cpu stay
+    busy together while memory stays bounded by the queue depths.
+    :param tasks: list of _process_case_task tasks
+    :param stage_counts: stage_stats for the readers
+    :param jobs: number of worker processes, 1 builds cases in this process
+    :param read_jobs: number of reader threads, 0 leaves reading to the workers
+    :param queue_depth: cases read ahead and waiting for a worker, defaults to 2 * jobs
+    :param scheduler: ljpeg_scheduler decompressing the LJPEGs of tasks in order,
+                      cases wait for their images and release them when they're built
+    :return: generator of _process_case_task results in task order
+    """
+    queue_depth = queue_depth or 2 * jobs
+    tasks = iter(tasks)
+    readers = ThreadPool(read_jobs) if read_jobs > 0 else None
+    pool = Pool(jobs) if jobs > 1 else None
+
+    # (task, read result) read ahead of the workers, oldest first
+    reading = deque()
+    # results of cases handed to the workers, or tasks to build here when there are none
+    running = deque()
+    try:
+        while True:
+            while len(reading) < queue_depth:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                read = None
+                if readers is not None:
+                    read = readers.apply_async(_read_ahead, (task[0], stage_counts, scheduler is None))
+                reading.append((task, read))
+
+            # one case queued behind each busy worker so none of them waits on this loop
+            while reading and len(running) < (2 * jobs if pool is not None else 1):
+                task, read = reading[0]
+                # rasters may be waiting for room the running cases hold
+                if running and scheduler is not None and \
+                        not all(scheduler.ready(p) for p in _case_ljpegs(task[0])):
+                    break
+                reading.popleft()
+                if read is not None:
+                    read.get()
+                if scheduler is not None:
+                    for ljpeg_path in _case_ljpegs(task[0]):
+                        if scheduler.wait(ljpeg_path) is None and ljpeg_path in scheduler.failures:
+                            print scheduler.failures[ljpeg_path]
+                running.append((task, pool.apply_async(_process_case_task, (task,)) if pool is not None else None))
+
+            if not running:
+                break
+            task, result = running.popleft()
+            result = result.get() if result is not None else _process_case_task(task)
+            if scheduler is not None:
+                for ljpeg_path in _case_ljpegs(task[0]):
+                    scheduler.release(ljpeg_path)
+            yield result
+    finally:
+        for p in (pool, readers):
+            if p is not None:
+                p.terminate()
+
+
+def make_data_set(root,
+                  out_dir,
+                  jobs=1,
+                  resume=True,
+                  crop_resize=None,
+                  compact_masks=False,
+                  tiled_images=False,
+                  codec='tiff',
+                  codec_level=None,
+                  encode_jobs=0,
+                  read_jobs=1,
+                  queue_depth=None,
+                  decompress_jobs=0,
+                  scratch_dir=None,
+                  scratch_budget=None,
+                  decompress_retries=2,
+                  decoder='native',
+                  progress_every=10.0,
+                  profile=None,
+                  profile_dir=None,
+                  shard=None):
+    """
+    Build the image data set and description csv for every abnormality under root.
+    Finished cases are recorded in build_manifest.jsonl in out_dir. With resume, a
+    rerun only rebuilds cases that are new, failed, or whose input files or
+    output parameters changed, and images of changed cases are rewritten.
+    Throughput and time left are printed as cases finish, and calls, seconds and
+    bytes of every stage of the build are written to build_stats.json in out_dir.
+    A shard builds only its cases and writes its csv, manifest and stats with the
+    shard's suffix, e.g. build_manifest.shard-0-of-4.jsonl, merge_data_set combines them.
+    :param root: root of the cases tree
+    :param out_dir: directory for the csv and image directories
+    :param jobs: number of worker processes, cases are split between them
+    :param resume: skip cases the manifest shows are up to date
+    :param crop_resize: (width, height) to resize od crops to, None keeps their size
+    :param compact_masks: save masks as bounding box .npz files instead of full size
+                          tiffs, ddsm_classes.load_mask rebuilds full size masks
+    :param tiled_images: save full od images as tiled .tiles files with downsampled
+                         levels instead of tiffs, tiled_image.tiled_image reads windows
+    :param codec: output codec of images and full size masks, one of image_codecs.codecs
+                  other than tiles, image_codecs.read_image reads them all
+    :param codec_level: compression level of codec, and of the tiled od images with
+                        tiled_images, None for their defaults. png and tiles take a
+                        zlib level, npz takes 0 for uncompressed, the tiffs take none,
+                        see image_codecs.check_level
+    :param encode_jobs: number of threads per worker encoding images while the
+                        next view is decoded, 0 encodes in line
+    :param read_jobs: number of threads reading the files of the next cases
+                      while the current ones are built, 0 reads in the workers
+    :param queue_depth: number of cases read ahead of the workers, defaults to 2 * jobs
+    :param decompress_jobs: number of jpegdir/jpeg processes decompressing LJPEGs
+                            ahead of the workers, which then read the decompressed
+                            images instead of decompressing them, 0 to not
+    :param scratch_dir: directory for the decompressed images, e.g. on a tmpfs,
+                        defaults to out_dir/ljpeg_scratch with decompress_jobs. Every
+                        image in it is deleted once its case is built, including those
+                        a worker decompresses itself, when decompress_jobs is 0 or the
+                        scheduler gave up on an LJPEG.
+    :param scratch_budget: bytes of images decompressed ahead of the workers allowed in
+                           scratch_dir at once, None for no limit. Those a worker
+                           decompresses itself aren't counted, there's at most one
+                           case of them per worker.
+    :param decompress_retries: times an LJPEG that fails to decompress is tried again
+    :param decoder: 'native' to decode the LJPEGs in the workers, 'subprocess' to
+                    decompress them with jpegdir/jpeg, see ddsm_abnormality.ljpeg_decoder.
+                    Images decompressed with decompress_jobs are read either way.
+    :param progress_every: seconds between progress lines
+    :param profile: 'cprofile' or 'sampling' to profile each worker process, see
+                    instrumentation.profiled, None to not profile
+    :param profile_dir: directory for the profiles, defaults to out_dir/profiles
+    :param shard: 'i/N' or (i, N) to build only shard i of N, see shards.case_shard.
+                  Every shard should get the same root, out_dir and options.
+    :return: None
+    """
+    suffix = ''
+    if shard is not None:
+        shard = parse_shard(shard)
+        suffix = shard_suffix(shard)
+
+    # fail before the build rather than in every case
+    check_level(codec, codec_level)
+    if tiled_images:
+        check_level('tiles', codec_level)
+
+    out_dirs = {
+        'img': os.path.join(out_dir, 'raw_images'),
+        'crop': os.path.join(out_dir, 'cropped_images'),
+        'od': os.path.join(out_dir, 'od_images'),
+        'od_crop': os.path.join(out_dir, 'od_cropped_images'),
+        'mask': os.path.join(out_dir, 'mask_images')
+    }
+
+    if profile is not None:
+        profile_dir = profile_dir or os.path.join(out_dir, 'profiles')
+        out_dirs['profiles'] = profile_dir
+
+    if decompress_jobs > 0:
+        scratch_dir = scratch_dir or os.path.join(out_dir, 'ljpeg_scratch')
+
+    for dir_path in out_dirs.values():
+        if not os.path.exists(dir_path):
+            os.mkdir(dir_path)
+
+    if scratch_dir is not None and not os.path.exists(scratch_dir):
+        os.makedirs(scratch_dir)
+
+    options = {
+        'crop_resize': crop_resize,
+        'compact_masks': compact_masks,
+        'tiled_images': tiled_images,
+        'codec': codec,
+        'codec_level': codec_level,
+        'encode_jobs': encode_jobs,
+        'scratch_dir': scratch_dir,
+        'decoder': decoder
+    }
+
+    # anything that changes the content of the images written
+    params = dict(options, od_range=ddsm_abnormality.od_range)
+    del params['encode_jobs']
+    del params['scratch_dir']
+    del params['decoder']
+    manifest = build_manifest(os.path.join(out_dir, 'build_manifest{}.jsonl'.format(suffix)), params)
+    if resume:
+        manifest.load()
+
+    start = time.time()
+    build_stats = stage_stats()
+
+    # finding the cases and checking them against the manifest
+    with build_stats.time('walk'):
+        cases = [case for case in find_cases(root) if in_shard(os.path.dirname(case[0]), root, shard)]
+        tasks = []
+        task_inputs = []
+        for case in cases:
+            inputs = case_inputs(case)
+            status = manifest.status(case, inputs)
+            if status == 'done':
+                continue
+            tasks.append((case, out_dirs, options, status == 'stale', (profile, profile_dir)))
+            task_inputs.append(inputs)
+
+    print "{} cases up to date, {} to build".format(len(cases) - len(tasks), len(tasks))
+
+    scheduler = None
+    if decompress_jobs > 0:
+        scheduler = ljpeg_scheduler(scratch_dir, decompress_jobs, scratch_budget, decompress_retries, build_stats)
+        scheduler.schedule(_decompress_groups(task[0] for task in tasks))
+
+    # results come back in case order whatever the number of workers
+    results = _pipeline(tasks, build_stats, jobs, read_jobs, queue_depth, scheduler)
+
+    count = 0
+    failed = 0
+    cache_counts = {'hits': 0, 'misses': 0, 'evictions': 0}
+    build_start = last_progress = time.time()
+    for done, (task, inputs, result) in enumerate(izip(tasks, task_inputs, results), 1):
+        ok, case_count, rows, messages, case_cache_counts, case_stage_counts = result
+        for message in messages:
+            print message
+
+        manifest.record(task[0], inputs, 'done' if ok else 'failed', case_count, rows)
+
+        for k in cache_counts:
+            cache_counts[k] += case_cache_counts[k]
+        build_stats.merge(case_stage_counts)
+        failed += not ok
+        count += case_count
+
+        now = time.time()
+        if now - last_progress >= progress_every or done == len(tasks):
+            last_progress = now
+            elapsed = now - build_start
+            print "case {}/{}, {} abnormalities, {:.1f} abnormalities/s, {:.1f} MB/s decoded, ETA {}".format(
+                done, len(tasks), count, count / elapsed if elapsed else 0.0,
+                build_stats.bytes('ljpeg_decode', 'raw_read') / 1024.0 ** 2 / elapsed if elapsed else 0.0,
+                format_eta(elapsed / done * (len(tasks) - done)))
+
+    if scheduler is not None:
+        scheduler.close()
+        if scheduler.failures:
+            print "{} LJPEGs failed to decompress and were left to the workers".format(len(scheduler.failures))
+
+    # rows of up to date cases come from the manifest
+    _write_description(os.path.join(out_dir, 'ddsm_description_cases{}.csv'.format(suffix)), cases, manifest)
+    manifest.compact(cases)
+
+    print "image cache: {hits} hits, {misses} misses, {evictions} evictions".format(**cache_counts)
+
+    # seconds of a stage are summed over workers and encoding threads, so
+    # with jobs or encode_jobs they can add up to more than the wall time
+    summary = OrderedDict([
+        ('seconds', time.time() - start),
+        ('jobs', jobs),
+        ('encode_jobs', encode_jobs),
+        ('shard', shard),
+        ('cases', len(cases)),
+        ('cases_built', len(tasks)),
+        ('cases_failed', failed),
+        ('abnormalities', count),
+        ('image_cache', cache_counts),
+        ('decompress_failures', list(scheduler.failures) if scheduler is not None else []),
+        ('stages', OrderedDict(build_stats.summary()))
+    ])
+    with open(os.path.join(out_dir, 'build_stats{}.json'.format(suffix)), 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    for stage, counts in summary['stages'].items():
+        print "{:14s} {:8d} calls {:9.2f} s{}".format(
+            stage, counts['calls'], counts['seconds'],
+            " {:8.1f} MB/s".format(counts['mb_per_second']) if counts['mb_per_second'] else "")
+
+
+def _write_description(csv_path, cases, manifest):
+    """
+    :param csv_path: path of the description csv
+    :param cases: cases in the order of their rows
+    :param manifest: build_manifest with the rows of every case
+    :return: None
+    """
+    with open(csv_path, 'w') as outfile:
+        outfile_writer = csv.writer(outfile, delimiter=',')
+        outfile_writer.writerow(fields)
+        for case in cases:
+            for row in manifest.rows(case):
+                outfile_writer.writerow(row)
+
+
+def merge_data_set(root, out_dir, count):
+    """
+    Combine the partial outputs of the shards of a sharded make_data_set into
+    the description csv and build manifest a single run over root writes, so
+    a later unsharded run resumes from them. Shards write their images into
+    out_dir directly, on several nodes their out_dirs are copied together first.
+    :param root: root of the cases tree, the cases are in its walk order
+    :param out_dir: output directory of every shard
+    :param count: number of shards
+    :return: None
+    """
+    manifests = []
+    for index in range(count):
+        manifest_path = os.path.join(out_dir, 'build_manifest{}.jsonl'.format(shard_suffix((index, count))))
+        if not os.path.exists(manifest_path):
+            raise ValueError("Shard {}/{} has no manifest at {}".format(index, count, manifest_path))
+        manifest = build_manifest(manifest_path, None)
+        manifest.load()
+        manifests.append(manifest)
+
+    cases = find_cases(root)
+    merged = build_manifest(os.path.join(out_dir, 'build_manifest.jsonl'), None)
+    for case in cases:
+        entry = next((m.cases[case[0]] for m in manifests if case[0] in m.cases), None)
+        if entry is None:
+            raise ValueError("Case {} wasn't built by any shard".format(case[0]))
+        if not merged.cases:
+            merged.params = entry['params']
+        elif entry['params'] != merged.params:
+            raise ValueError("Case {} was built with different parameters".format(case[0]))
+        merged.cases[case[0]] = entry
+
+    _write_description(os.path.join(out_dir, 'ddsm_description_cases.csv'), cases, merged)
+    merged.compact(cases)
 
 
 if __name__ == '__main__':
-    make_data_set('/Volumes/DDSM/DDSM/figment.csee.usf.edu/pub/DDSM/cases/',
-                  out_dir='/Volumes/DDSM/ddsm_2015/processed_data_set')
+    parser = argparse.ArgumentParser(description="Build the DDSM image data set")
+    parser.add_argument('root', nargs='?', default='/Volumes/DDSM/DDSM/figment.csee.usf.edu/pub/DDSM/cases/')
+    parser.add_argument('out_dir', nargs='?', default='/Volumes/DDSM/ddsm_2015/processed_data_set')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--shard', help="build only shard i/N of the cases")
+    parser.add_argument('--decoder', choices=['native', 'subprocess'], default='native',
+                        help="decode LJPEGs in process or with jpegdir/jpeg")
+    parser.add_argument('--merge', type=int, metavar='N', help="merge the outputs of N shards")
+    args = parser.parse_args()
+
+    if args.merge:
+        merge_data_set(args.root, args.out_dir, args.merge)
+    else:
+        make_data_set(args.root, out_dir=args.out_dir, jobs=args.jobs, shard=args.shard, decoder=args.decoder)
@@ -0,0 +1,258 @@
+from itertools import imap
+from multiprocessing import Pool
+
+import numpy as np
+
+from parse_ddsm_metadata import iter_views
+
+
+####################################################
+# Patch coordinates
+####################################################
+def _positive_centers(abnormalities, count, rng):
+    """
+    :param abnormalities: ddsm_abnormality objects on one view
+    :param count: number of centers
+    :param rng: numpy RandomState
+    :return: (rows, cols) of centers drawn uniformly from inside the rois,
+             each roi is equally likely
+    """
+    which = rng.randint(len(abnormalities), size=count)
+    rows = np.empty(count, dtype=np.intp)
+    cols = np.empty(count, dtype=np.intp)
+    for i, abnormality in enumerate(abnormalities):
+        picked = np.flatnonzero(which == i)
+        if not len(picked):
+            continue
+        mask, (row, col) = abnormality.roi_mask()
+        inside = np.flatnonzero(mask)
+        if not len(inside):  # degenerate roi, use its corner
+            inside = np.zeros(1, dtype=np.intp)
+        chosen = inside[rng.randint(len(inside), size=len(picked))]
+        rows[picked] = row + chosen // mask.shape[1]
+        cols[picked] = col + chosen % mask.shape[1]
+    return rows, cols
+
+
+def _negative_centers(abnormalities, tissue, stride, count, extents, rng, jitter=0, tries=4):
+    """
+    :param abnormalities: ddsm_abnormality objects on one view
+    :param tissue: boolean breast tissue mask of the view sampled every stride pixels
+    :param stride: spacing of the tissue mask in image pixels
+    :param count: number of centers
+    :param extents: half the side of each patch in image pixels, length count
+    :param rng: numpy RandomState
+    :param jitter: maximum shift in pixels added to each center, before the centers are checked
+    :return: (rows, cols, extents) of up to count centers on breast tissue whose
+             patches don't touch the bounding box of any roi
+    """
+    candidates = np.flatnonzero(tissue)
+    if not len(candidates):
+        empty = np.zeros(0, dtype=np.intp)
+        return empty, empty, extents[:0]
+
+    bounds = np.array([[a.y_lo, a.y_hi, a.x_lo, a.x_hi] for a in abnormalities])
+
+    rows, cols, kept = [], [], []
+    needed = count
+    for _ in range(tries):
+        n = 2 * needed
+        chosen = candidates[rng.randint(len(candidates), size=n)]
+        r = (chosen // tissue.shape[1]) * stride + rng.randint(stride, size=n)
+        c = (chosen % tissue.shape[1]) * stride + rng.randint(stride, size=n)
+        if jitter:
+            r += rng.randint(-jitter, jitter + 1, size=n)
+            c += rng.randint(-jitter, jitter + 1, size=n)
+        e = extents[rng.randint(len(extents), size=n)]
+
+        # jitter can move a center off the tissue or out of the image
+        on_tissue = (r >= 0) & (c >= 0) & (r < tissue.shape[0] * stride) & (c < tissue.shape[1] * stride)
+        on_tissue[on_tissue] = tissue[r[on_tissue] // stride, c[on_tissue] // stride]
+
+        # patches overlapping any roi bounding box, (n, rois)
+        overlaps = ((r[:, None] + e[:, None] >= bounds[:, 0]) &
+                    (r[:, None] - e[:, None] <= bounds[:, 1]) &
+                    (c[:, None] + e[:, None] >= bounds[:, 2]) &
+                    (c[:, None] - e[:, None] <= bounds[:, 3]))
+        ok = on_tissue & ~overlaps.any(axis=1)
+
+        rows.append(r[ok][:needed])
+        cols.append(c[ok][:needed])
+        kept.append(e[ok][:needed])
+        needed -= len(rows[-1])
+        if needed == 0:
+            break
+
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(kept)
+
+
+def extract_patches(im, rows, cols, size, scales):
+    """
+    Cut square patches out of an image in one vectorized gather. A patch at scale s
+    covers size * s image pixels, sampled at the nearest pixel, so only the pixels
+    in the patches are read from a memory mapped image. Patches are clamped at the
+    image edges.
+    :param im: 2d image
+    :param rows: patch center rows
+    :param cols: patch center columns
+    :param size: side of the patches in output pixels
+    :param scales: scale of each patch
+    :return: (n, size, size) patches in the dtype of im
+    """
+    # output pixel i samples the image pixel under the center of its cell
+    grid = np.arange(size) + 0.5 - size / 2.0
+    r = np.floor(rows[:, None] + grid[None, :] * scales[:, None]).astype(np.intp)
+    c = np.floor(cols[:, None] + grid[None, :] * scales[:, None]).astype(np.intp)
+    np.clip(r, 0, im.shape[0] - 1, out=r)
+    np.clip(c, 0, im.shape[1] - 1, out=c)
+    return im[r[:, :, None], c[:, None, :]]
+
+
+def sample_view(abnormalities,
+                patch_size=64,
+                positives=16,
+                negatives=16,
+                jitter=0,
+                scale=(1.0, 1.0),
+                od_correct=True,
+                tissue_threshold=70,
+                tissue_stride=16,
+                seed=None):
+    """
+    Draw labeled patches from one view
+    :param abnormalities: ddsm_abnormality objects on the view
+    :param patch_size: side of the patches in output pixels
+    :param positives: number of patches centered inside a roi, label 1
+    :param negatives: number of patches on breast tissue away from every roi, label 0
+    :param jitter: maximum shift in pixels added to each center, negatives are shifted
+                   before they're checked against the rois and the tissue
+    :param scale: (low, high) range each patch's scale is drawn from
+    :param od_correct: return uint8 optical density patches, otherwise raw uint16
+    :param tissue_threshold: uint8 optical density above which a pixel is breast tissue,
+                             the background is near 63 after the od clip at 3.0
+    :param tissue_stride: spacing of the grid the tissue mask is computed on
+    :param seed: seed of this view's random draws
+    :return: (patches, labels), fewer negatives than asked for if the view has too little tissue
+    """
+    rng = np.random.RandomState(seed)
+    first = abnormalities[0]
+    raw = first.image.raw()
+    table = first._od_table()
+
+    scales = rng.uniform(scale[0], scale[1], size=positives + negatives)
+    extents = np.ceil(scales * patch_size / 2.0).astype(np.intp)
+
+    pos_rows, pos_cols = _positive_centers(abnormalities, positives, rng)
+    if jitter:
+        pos_rows += rng.randint(-jitter, jitter + 1, size=positives)
+        pos_cols += rng.randint(-jitter, jitter + 1, size=positives)
+
+    tissue = table[raw[::tissue_stride, ::tissue_stride]] > tissue_threshold
+    neg_rows, neg_cols, neg_extents = _negative_centers(abnormalities, tissue, tissue_stride,
+                                                        negatives, extents[positives:], rng, jitter)
+
+    rows = np.concatenate([pos_rows, neg_rows])
+    cols = np.concatenate([pos_cols, neg_cols])
+    scales = np.concatenate([scales[:positives], neg_extents * 2.0 / patch_size])
+
+    patches = extract_patches(raw, rows, cols, patch_size, scales)
+    patches = table[patches] if od_correct else patches.astype(np.uint16)
+    labels = np.concatenate([np.ones(positives, dtype=np.uint8), np.zeros(len(neg_rows), dtype=np.uint8)])
+    return patches, labels
+
+
+def _sample_view_task(task):
+    """
+    Pool entry point
+    :param task: (abnormalities, sample_view keyword arguments)
+    :return: (patches, labels), None if the view can't be read
+    """
+    abnormalities, kwargs = task
+    try:
+        return sample_view(abnormalities, **kwargs)
+    except ValueError:
+        return None
+
+
+####################################################
+# Sampler
+####################################################
+class patch_sampler(object):
+    """
+    Draws batches of labeled patches from every view with abnormalities,
+    straight from decoded or memory mapped images. Views are sampled by a
+    pool of worker processes, and each epoch draws new patches.
+    """
+
+    def __init__(self, views, jobs=1, seed=0, **options):
+        """
+        :param views: lists of ddsm_abnormality objects, one list per view
+        :param jobs: number of worker processes
+        :param seed: base seed, patches depend only on it, the epoch and the view
+        :param options: keyword arguments of sample_view
+        """
+        self.views = views
+        self.jobs = jobs
+        self.seed = seed
+        self.options = options
+
+    @classmethod
+    def from_tree(cls, root, abnormality_type=None, **kwargs):
+        """
+        :param root: root of the cases tree
+        :param abnormality_type: only sample views with this type of abnormality, e.g. 'mass'
+        :param kwargs: arguments of patch_sampler
+        :return: patch_sampler over the views under root
+        """
+        return cls(list(iter_views(root, abnormality_type)), **kwargs)
+
+    def epoch(self, epoch=0, batch_size=256, shuffle_views=8):
+        """
+        :param epoch: epoch number, seeds the draws with the base seed
+        :param batch_size: patches per batch
+        :param shuffle_views: number of views whose patches are mixed before batching
+        :return: generator of (uint8 or uint16 (n, size, size) patches, uint8 labels),
+                 the last batch may be short
+        """
+        rng = np.random.RandomState([self.seed, epoch])
+        order = rng.permutation(len(self.views))
+        seeds = rng.randint(2 ** 31, size=len(self.views))
+
+        tasks = []
+        for i in order:
+            kwargs = dict(self.options, seed=seeds[i])
+            tasks.append((self.views[i], kwargs))
+
+        pool = None
+        if self.jobs > 1:
+            pool = Pool(self.jobs)
+            results = pool.imap(_sample_view_task, tasks)
+        else:
+            results = imap(_sample_view_task, tasks)
+
+        try:
+            buffered = []
+            for idx, result in enumerate(results):
+                if result is None:
+                    print "Error with abnormality at " + self.views[order[idx]][0].input_file_path
+                else:
+                    buffered.append(result)
+
+                if len(buffered) < shuffle_views and idx < len(tasks) - 1:
+                    continue
+                if not buffered:
+                    continue
+
+                patches = np.concatenate([p for p, _ in buffered])
+                labels = np.concatenate([l for _, l in buffered])
+                mix = rng.permutation(len(labels))
+                patches, labels = patches[mix], labels[mix]
+
+                # keep the remainder for the next batches unless this is the end
+                end = len(labels) if idx == len(tasks) - 1 else len(labels) // batch_size * batch_size
+                for start in range(0, end, batch_size):
+                    yield patches[start:min(end, start + batch_size)], labels[start:min(end, start + batch_size)]
+                buffered = [(patches[end:], labels[end:])] if end < len(labels) else []
+        finally:
+            if pool is not None:
+                pool.terminate()
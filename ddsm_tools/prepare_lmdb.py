@@ -1,7 +1,19 @@
+import argparse
+import hashlib
+import heapq
 import pandas as pd
 import os
+import shutil
+from itertools import imap
+from multiprocessing import Pool
 from subprocess import call
 import numpy as np
+from PIL import Image
+
+from image_stats import image_stats
+from lmdb_writer import encode_datum, datum_label, iter_lmdb, lmdb_writer
+from parse_ddsm_metadata import iter_views
+from shards import in_shard, parse_shard, shard_suffix
 
 
 def get_file_names(data_dir, descriptor, split=None, ext='.txt'):
@@ -10,54 +22,81 @@ def get_file_names(data_dir, descriptor, split=None, ext='.txt'):
     return lmdb, idx
 
 
-def make_train_val_test_splits(size, probs=(0.85, 0.05, 0.1)):
+split_names = ['train', 'val', 'test']
+
+
+def _split_bounds(probs):
     """
-    Make array of values {train, val, test} with distribution
-    according to probs
-    :param size: length of output array
     :param probs: (p_train, p_val, p_test)
-    :return: list w/len size of train, val, test
+    :return: upper bounds of train and val in [0, 1)
     """
-    assert np.sum(probs) == 1
+    if not np.isclose(np.sum(probs), 1):
+        raise ValueError("Split probabilities {} don't add up to 1".format(probs))
+    return np.cumsum(probs)[:-1]
 
-    num_train = int(size * probs[0])
-    num_val = int(size * probs[1])
-    num_test = size - (num_train + num_val)
 
-    splits = (['train'] * num_train)
-    splits.extend(['val'] * num_val)
-    splits.extend(['test'] * num_test)
+def _patient_fraction(patient_id, seed):
+    """
+    :return: stable hash of the seed and patient_id, uniform in [0, 1)
+    """
+    digest = hashlib.md5("{}:{}".format(seed, patient_id)).hexdigest()
+    return int(digest[:13], 16) / float(16 ** 13)
 
-    np.random.shuffle(splits)
 
-    return splits
+def patient_split(patient_id, probs=(0.85, 0.05, 0.1), seed=0):
+    """
+    Split of a patient from a hash of the seed and patient_id, so all of a patient's
+    lesions are in one split, and every run and machine agrees on it one row at a time.
+    The shares of the splits are probs over patients rather than rows.
+    :param patient_id: patient id, e.g. A-0001-1
+    :param probs: (p_train, p_val, p_test)
+    :param seed: changes which patients go where
+    :return: 'train', 'val' or 'test'
+    """
+    code = np.searchsorted(_split_bounds(probs), _patient_fraction(patient_id, seed), side='right')
+    return split_names[int(code)]
+
+
+def patient_splits(patient_ids, probs=(0.85, 0.05, 0.1), seed=0):
+    """
+    patient_split of every row, hashing each distinct patient once
+    :param patient_ids: sequence of patient ids
+    :return: array of 'train', 'val' and 'test'
+    """
+    unique, inverse = np.unique(np.asarray(patient_ids, dtype=str), return_inverse=True)
+    fractions = np.array([_patient_fraction(p, seed) for p in unique], dtype=np.float64)
+    codes = np.searchsorted(_split_bounds(probs), fractions, side='right')
+    return np.array(split_names)[codes][inverse]
 
 
-def make_lmdb_config_files(label, df, data_dir):
+def make_lmdb_config_files(label, df, data_dir, probs=(0.85, 0.05, 0.1), seed=0):
     """
     Create the csv files necessary to create lmdb for a label in the data frame.
     Takes care to split cases with multiple labels into their component pieces.
     :param label: which label to perform classification
-    :param df: dataframe with all data
+    :param df: dataframe with all data, including patient_id
+    :param probs: (p_train, p_val, p_test) of patients, see patient_split
+    :param seed: seed of the split assignment
     :return: None
     """
     # make sure descriptor or path is null
-    data = df[[label, 'od_crop_path']].dropna()
+    data = df[[label, 'od_crop_path', 'patient_id']].dropna().reset_index(drop=True)
 
-    # duplicate items with multiple annotations
-    rows = []
-    for idx, dname, im_path in data.itertuples():
-        im_path = os.path.basename(im_path)
-        rows.extend([(im_path, d) for d in dname.split('-')])
+    # duplicate items with multiple annotations, one row per part of e.g. OVAL-LOBULATED
+    parts = data[label].str.split('-', expand=True).stack()
+    rows = parts.index.get_level_values(0)
+    data = pd.DataFrame({'path': data['od_crop_path'].str.split('/').str[-1].values[rows],
+                         label: parts.values,
+                         'patient_id': data['patient_id'].values[rows]},
+                        columns=['path', label, 'patient_id'])
 
     # convert labels to numbers
-    data = pd.DataFrame(rows, columns=['path', label])
     cat_desc = pd.Categorical(data[label])
     data[label] = cat_desc
     data['desc_codes'] = cat_desc.codes
 
     # make train/val/test splits
-    data['splits'] = make_train_val_test_splits(len(data.index))
+    data['splits'] = patient_splits(data['patient_id'], probs, seed)
 
     # write out lmdb ref file
     for split in ['train', 'val', 'test']:
@@ -120,9 +159,222 @@ def make_lmdb(data_dir,
             call_str = " ".join(call_lst)
             call(call_str, shell=True)
 
-def make_data_sets(data_dir, data_csv_name):
-    df = pd.read_csv(os.path.join(data_dir, data_csv_name))
-    mass = df[df.abnormality_type == 'mass']  # get masses
+####################################################
+# LMDB data sets straight from the DDSM tree
+####################################################
+def _encode_view(task):
+    """
+    Crop, resize and serialize every abnormality on a view, and accumulate
+    training statistics of the crops
+    :param task: (ddsm_abnormality objects on one view, (width, height) to resize to or None,
+                  for each abnormality the labels whose training set it's in, once per record)
+    :return: (list of serialized Datums without labels, dictionary of label -> image_stats),
+             None if the view can't be read
+    """
+    abnormalities, resize, train_labels = task
+    datums = []
+    stats = {}
+    try:
+        for abnormality, labels in zip(abnormalities, train_labels):
+            im = abnormality.image.crop(od_correct=True)
+            if resize:
+                im = np.array(Image.fromarray(im).resize(resize, resample=Image.LINEAR))
+            datums.append(encode_datum(im))
+
+            # crops are only the same size for per-pixel images when resized
+            for label in labels:
+                stats.setdefault(label, image_stats(per_pixel=bool(resize))).add(im)
+    except ValueError:
+        return None
+    return datums, stats
+
+
+def make_native_data_sets(root,
+                          data_dir,
+                          lmdb_output_dir,
+                          labels=('mass_margins', 'mass_shape'),
+                          resize=(256, 256),
+                          jobs=1,
+                          batch_size=1000,
+                          seed=0,
+                          shard=None):
+    """
+    Build train/val/test lmdbs of uint8 optical density mass crops for each label
+    in one pass over the DDSM tree, without writing tiffs or calling caffe tools.
+    Crops with several annotations get one record per annotation, as in
+    make_lmdb_config_files, and records are shuffled by their keys.
+    Mean and variance images and intensity statistics of each training set
+    are accumulated by the encoders as records are made, see image_stats.
+    Records are written to partial lmdbs first and merged in key order, so a
+    sharded build merged with merge_native_data_sets is byte for byte the same
+    as a single one.
+    :param root: root of the cases tree
+    :param data_dir: directory for the label indices files and mean_images
+    :param lmdb_output_dir: directory for the lmdbs
+    :param labels: mass fields to make data sets for
+    :param resize: (width, height) to resize crops to, None keeps their size
+    :param jobs: number of processes cropping and encoding views
+    :param batch_size: records per lmdb transaction
+    :param seed: seed of the splits, see patient_split, and of the record order,
+                 every shard needs the same one
+    :param shard: 'i/N' or (i, N) to encode only the views of shard i of N, see
+                  shards.case_shard, leaving its partial lmdbs and statistics for
+                  merge_native_data_sets. None builds and merges everything.
+    :return: None
+    """
+    rng = np.random.RandomState(seed)
+    partial = (0, 1) if shard is None else parse_shard(shard)
+    suffix = shard_suffix(partial)
+
+    # metadata only, views are read by the encoders
+    views = list(iter_views(root, 'mass'))
+
+    # (view, abnormality) -> [(label, split, code, key)], the same for every shard
+    assignments = {}
+    for label in labels:
+        rows = []
+        for view_idx, abnormalities in enumerate(views):
+            for abn_idx, abnormality in enumerate(abnormalities):
+                value = getattr(abnormality, label)
+                if value is not None:
+                    rows.extend([(view_idx, abn_idx, d) for d in value.split('-')])
+
+        names = sorted(set(d for _, _, d in rows))
+        codes = dict((n, idx) for idx, n in enumerate(names))
+        splits = patient_splits([views[view_idx][abn_idx].patient_id for view_idx, abn_idx, _ in rows], seed=seed)
+
+        # caffe reads in key order, so a shuffled key prefix shuffles the records
+        for split in ['train', 'val', 'test']:
+            split_rows = [r for r, s in zip(rows, splits) if s == split]
+            for order, (view_idx, abn_idx, d) in zip(rng.permutation(len(split_rows)), split_rows):
+                abnormality = views[view_idx][abn_idx]
+                key = "{:08d}_{}_{}".format(order, os.path.basename(abnormality.input_file_path), abnormality.abn_num)
+                assignments.setdefault((view_idx, abn_idx), []).append((label, split, codes[d], key))
+
+        _, desc_idx_path = get_file_names(data_dir, label)
+        with open(desc_idx_path, 'w') as f:
+            for idx, n in enumerate(names):
+                f.write("{}\t {}\n".format(n, idx))
+
+    writers = {}
+    for label in labels:
+        for split in ['train', 'val', 'test']:
+            lmdb_path, _ = get_file_names(lmdb_output_dir, label, split=split, ext=suffix)
+            writers[(label, split)] = lmdb_writer(lmdb_path, batch_size)
+    train_stats = dict((label, image_stats(per_pixel=bool(resize))) for label in labels)
+
+    tasks = []
+    view_indices = []
+    for view_idx, abnormalities in enumerate(views):
+        if not in_shard(os.path.dirname(abnormalities[0].input_file_path), root, partial):
+            continue
+        train_labels = [[label for label, split, _code, _key in assignments.get((view_idx, abn_idx), [])
+                         if split == 'train'] for abn_idx in range(len(abnormalities))]
+        tasks.append((abnormalities, resize, train_labels))
+        view_indices.append(view_idx)
+    pool = None
+    if jobs > 1:
+        pool = Pool(jobs)
+        results = pool.imap(_encode_view, tasks)
+    else:
+        results = imap(_encode_view, tasks)
+
+    for view_idx, result in zip(view_indices, results):
+        if result is None:
+            print "Error with abnormality at " + views[view_idx][0].input_file_path
+            continue
+
+        datums, view_stats = result
+        for abn_idx, datum in enumerate(datums):
+            for label, split, code, key in assignments.get((view_idx, abn_idx), []):
+                writers[(label, split)].put(key, datum + datum_label(code))
+
+        for label, stats in view_stats.items():
+            train_stats[label].merge(stats)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    for writer in writers.values():
+        writer.close()
+
+    mean_dir = os.path.join(data_dir, 'mean_images')
+    if not os.path.exists(mean_dir):
+        os.mkdir(mean_dir)
+    for label in labels:
+        train_stats[label].save_partial(os.path.join(mean_dir, '{}{}.npz'.format(label, suffix)))
+
+    if shard is None:
+        merge_native_data_sets(data_dir, lmdb_output_dir, 1, labels, batch_size, remove_partials=True)
+
+
+def merge_native_data_sets(data_dir,
+                           lmdb_output_dir,
+                           count,
+                           labels=('mass_margins', 'mass_shape'),
+                           batch_size=1000,
+                           remove_partials=False):
+    """
+    Merge the partial lmdbs and training statistics of the shards of
+    make_native_data_sets into the final lmdbs and mean_images. Records are
+    written in key order and the statistics are exact sums, so the result
+    doesn't depend on the number of shards.
+    :param data_dir: data_dir of every shard
+    :param lmdb_output_dir: lmdb_output_dir of every shard
+    :param count: number of shards
+    :param labels: labels the shards were built for
+    :param batch_size: records per lmdb transaction
+    :param remove_partials: delete the partial outputs once they're merged
+    :return: None
+    """
+    suffixes = [shard_suffix((index, count)) for index in range(count)]
+    mean_dir = os.path.join(data_dir, 'mean_images')
+
+    for label in labels:
+        for split in ['train', 'val', 'test']:
+            lmdb_path, _ = get_file_names(lmdb_output_dir, label, split=split, ext='')
+            partial_paths = [lmdb_path + suffix for suffix in suffixes]
+            for partial_path in partial_paths:
+                if not os.path.exists(partial_path):
+                    raise ValueError("Missing partial lmdb {}".format(partial_path))
+
+            with lmdb_writer(lmdb_path, batch_size) as writer:
+                for key, value in heapq.merge(*[iter_lmdb(path) for path in partial_paths]):
+                    writer.put(key, value)
+            print "{} {}: {} records".format(label, split, writer.count)
+
+            if remove_partials:
+                for partial_path in partial_paths:
+                    shutil.rmtree(partial_path)
+
+        # statistics of training data, {label}_mean.binaryproto is what compute_image_mean writes
+        partial_paths = [os.path.join(mean_dir, '{}{}.npz'.format(label, suffix)) for suffix in suffixes]
+        train_stats = image_stats.load_partial(partial_paths[0])
+        for partial_path in partial_paths[1:]:
+            train_stats.merge(image_stats.load_partial(partial_path))
+        train_stats.save(mean_dir, label)
+
+        if remove_partials:
+            for partial_path in partial_paths:
+                os.remove(partial_path)
+
+
+def make_data_sets(data_dir, data_csv_name, catalog_path=None):
+    """
+    :param data_dir: output directory of make_data_set
+    :param data_csv_name: name of the csv written by make_data_set
+    :param catalog_path: catalog written by ddsm_catalog.build_catalog,
+                         read instead of the csv when given
+    :return: None
+    """
+    if catalog_path is not None:
+        from ddsm_catalog import ddsm_catalog
+        catalog = ddsm_catalog(catalog_path).select(abnormality_type='mass')
+        mass = catalog.to_dataframe(['patient_id', 'mass_margins', 'mass_shape', 'od_crop_path'])
+    else:
+        df = pd.read_csv(os.path.join(data_dir, data_csv_name))
+        mass = df[df.abnormality_type == 'mass']  # get masses
 
     # make csv for lmdb creation
     make_lmdb_config_files('mass_margins', mass, data_dir)
@@ -134,4 +386,16 @@ def make_data_sets(data_dir, data_csv_name):
 
 
 if __name__ == '__main__':
-    make_data_sets('/home/ubuntu/processed_data_set', 'ddsm_description_cases.csv')
+    parser = argparse.ArgumentParser(description="Build lmdbs of mass crops from the DDSM tree")
+    parser.add_argument('root', nargs='?', default='/Volumes/DDSM/DDSM/figment.csee.usf.edu/pub/DDSM/cases/')
+    parser.add_argument('data_dir', nargs='?', default='/home/ubuntu/processed_data_set')
+    parser.add_argument('lmdb_output_dir', nargs='?', default='/home/ubuntu/processed_data_set/lmdb/')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--shard', help="encode only shard i/N of the cases")
+    parser.add_argument('--merge', type=int, metavar='N', help="merge the outputs of N shards")
+    args = parser.parse_args()
+
+    if args.merge:
+        merge_native_data_sets(args.data_dir, args.lmdb_output_dir, args.merge)
+    else:
+        make_native_data_sets(args.root, args.data_dir, args.lmdb_output_dir, jobs=args.jobs, shard=args.shard)
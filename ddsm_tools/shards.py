@@ -0,0 +1,55 @@
+import hashlib
+import os
+
+
+####################################################
+# Sharding by case
+####################################################
+# Every node walks the whole tree and keeps the cases whose hash falls in its
+# shard, so nodes agree on the split without talking to each other.
+def parse_shard(shard):
+    """
+    :param shard: 'i/N' or (i, N), shard i of N counting from 0
+    :return: (i, N)
+    """
+    if isinstance(shard, basestring):
+        try:
+            index, count = [int(v) for v in shard.split('/')]
+        except ValueError:
+            raise ValueError("Shard should look like i/N, not {}".format(shard))
+    else:
+        index, count = shard
+
+    if not 0 <= index < count:
+        raise ValueError("Shard {}/{} is out of range".format(index, count))
+    return index, count
+
+
+def shard_suffix(shard):
+    """
+    :param shard: (i, N)
+    :return: suffix of the partial outputs of the shard
+    """
+    return '.shard-{}-of-{}'.format(*shard)
+
+
+def case_shard(case_dir, root, count):
+    """
+    :param case_dir: directory of a case
+    :param root: root of the cases tree
+    :param count: number of shards
+    :return: shard of the case, from a hash of its path relative to root,
+             so it's the same wherever the tree is mounted
+    """
+    rel_path = os.path.relpath(os.path.normpath(case_dir), os.path.normpath(root))
+    return int(hashlib.md5(rel_path.replace(os.sep, '/')).hexdigest()[:8], 16) % count
+
+
+def in_shard(case_dir, root, shard):
+    """
+    :param case_dir: directory of a case
+    :param root: root of the cases tree
+    :param shard: (i, N), None for every case
+    :return: True if the case belongs to the shard
+    """
+    return shard is None or case_shard(case_dir, root, shard[1]) == shard[0]
@@ -0,0 +1,238 @@
+import os
+import sys
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from ddsm_classes import ddsm_abnormality
+from ddsm_util import scanner_map
+
+
+####################################################
+# Synthetic DDSM corpus
+####################################################
+# scanner letter, DIGITIZER line, bits per pixel, resolution in microns
+scanners = [
+    ('A', 'DBA 21', 16, 42.0),
+    ('A', 'HOWTEK MULTIRAD850', 12, 43.5),
+    ('B', 'LUMISYS LASER', 12, 50.0),
+    ('C', 'LUMISYS LASER', 12, 50.0),
+    ('D', 'HOWTEK MULTIRAD850', 12, 43.5)
+]
+
+# (directory, volume prefix, pathology) for cases with lesions
+volumes = [
+    ('benigns', 'benign', 'BENIGN'),
+    ('cancers', 'cancer', 'MALIGNANT'),
+    ('benign_without_callbacks', 'benign_without_callback', 'BENIGN_WITHOUT_CALLBACK')
+]
+
+mass_shapes = ['ROUND', 'OVAL', 'LOBULATED', 'IRREGULAR', 'OVAL-LOBULATED']
+mass_margins = ['CIRCUMSCRIBED', 'MICROLOBULATED', 'OBSCURED', 'ILL_DEFINED', 'SPICULATED', 'ILL_DEFINED-SPICULATED']
+calc_types = ['PLEOMORPHIC', 'AMORPHOUS', 'PUNCTATE', 'LUCENT_CENTER', 'FINE_LINEAR_BRANCHING']
+calc_distributions = ['CLUSTERED', 'LINEAR', 'SEGMENTAL', 'REGIONAL', 'DIFFUSELY_SCATTERED']
+
+sequences = ['LEFT_CC', 'RIGHT_CC', 'LEFT_MLO', 'RIGHT_MLO']
+
+# xy step -> chain code, the inverse of ddsm_abnormality.chain_lut
+_chain_codes = dict((tuple(step), code) for code, step in enumerate(ddsm_abnormality.chain_lut.tolist()))
+
+
+def _gray_levels(od, scanner_type, scan_institution, bpp):
+    """
+    Invert ddsm_abnormality._od_correct for a scanner
+    :param od: optical density image
+    :return: gray levels clipped to bpp bits, as uint16
+    """
+    if scan_institution == 'MGH' and scanner_type == 'DBA':
+        im = 10 ** (4.80662 - 1.07553 * od) - 1
+    elif scan_institution == 'MGH' and scanner_type == 'HOWTEK':
+        im = (3.789 - od) / 0.00094568
+    elif scan_institution == 'WFU' and scanner_type == 'LUMISYS':
+        im = 4096.99 - 1009.01 * od
+    else:
+        im = (3.96604095240593 - od) / 0.00099055807612
+    return np.clip(np.rint(im), 0, 2 ** bpp - 1).astype(np.uint16)
+
+
+def _smooth_noise(shape, cell, rng):
+    """
+    :param shape: (height, width)
+    :param cell: size of the noise features in pixels
+    :param rng: numpy RandomState
+    :return: noise in about -1..1 that varies over cell pixels
+    """
+    coarse = rng.uniform(-1, 1, size=(shape[0] // cell + 2, shape[1] // cell + 2)).astype(np.float32)
+    im = Image.fromarray(coarse, mode='F').resize((coarse.shape[1] * cell, coarse.shape[0] * cell), Image.BILINEAR)
+    return np.array(im)[:shape[0], :shape[1]]
+
+
+def _outline(cx, cy, radius, roughness, rng):
+    """
+    Random closed blob around a center
+    :return: (N, 2) int xy points of the boundary, each 8-connected to the next
+    """
+    theta = np.linspace(0, 2 * np.pi, int(8 * np.pi * radius), endpoint=False)
+    r = np.ones_like(theta)
+    for k in range(2, 7):
+        r += roughness * rng.uniform(0, 1.0 / k) * np.cos(k * theta + rng.uniform(0, 2 * np.pi))
+    r *= radius
+    xy = np.rint(np.c_[cx + r * np.cos(theta), cy + r * np.sin(theta)]).astype(np.int64)
+
+    # fill gaps so every step moves at most one pixel in x and y
+    points = [xy[0]]
+    for target in np.vstack([xy[1:], xy[:1]]):
+        while True:
+            step = np.clip(target - points[-1], -1, 1)
+            if not step.any():
+                break
+            points.append(points[-1] + step)
+    return np.array(points[:-1])
+
+
+def _chain_code(points):
+    """
+    :param points: (N, 2) closed 8-connected boundary
+    :return: (start x, start y, list of chain codes) as in an OVERLAY BOUNDARY line
+    """
+    steps = np.diff(np.vstack([points, points[:1]]), axis=0)
+    return points[0][0], points[0][1], [_chain_codes[tuple(s)] for s in steps.tolist()]
+
+
+def _lesion(kind, height, width, breast, rng):
+    """
+    :param kind: 'mass' or 'calcification'
+    :param breast: boolean mask of the breast at 1/16 scale
+    :return: (xy boundary points, LESION_TYPE line)
+    """
+    ys, xs = np.nonzero(breast)
+    i = rng.randint(len(ys))
+    cy, cx = ys[i] * 16 + 8, xs[i] * 16 + 8
+
+    if kind == 'mass':
+        radius = rng.uniform(0.02, 0.06) * min(height, width)
+        lesion_type = "LESION_TYPE MASS SHAPE {} MARGINS {}".format(rng.choice(mass_shapes), rng.choice(mass_margins))
+    else:
+        radius = rng.uniform(0.01, 0.08) * min(height, width)
+        lesion_type = "LESION_TYPE CALCIFICATION TYPE {} DISTRIBUTION {}".format(
+            rng.choice(calc_types), rng.choice(calc_distributions))
+
+    points = _outline(cx, cy, radius, 0.8 if kind == 'mass' else 0.4, rng)
+
+    # move lesions near the edge back inside the image
+    lo, hi = points.min(axis=0), points.max(axis=0)
+    limit = np.array([width - 2, height - 2])
+    points += np.maximum(0, 1 - lo) - np.maximum(0, hi - limit)
+    return points, lesion_type
+
+
+def _view(height, width, side, rng):
+    """
+    Optical density image of a breast on film
+    :return: (od image, breast mask at 1/16 scale)
+    """
+    yy, xx = np.ogrid[:height, :width]
+    chest_x = 0 if side == 'LEFT' else width - 1
+    dist = ((xx - chest_x) / (0.8 * width)) ** 2 + ((yy - height / 2.0) / (0.45 * height)) ** 2
+    breast = dist < 1
+
+    od = np.full((height, width), 3.2, dtype=np.float32)  # unexposed film around the breast
+    tissue = 1.2 + 0.4 * dist + 0.25 * _smooth_noise((height, width), 64, rng) + \
+        0.08 * _smooth_noise((height, width), 8, rng)
+    od[breast] = tissue[breast]
+    od += rng.normal(0, 0.02, size=od.shape).astype(np.float32)
+    return od, breast[::16, ::16]
+
+
+def make_synthetic_corpus(root, cases=4, height=4600, width=3000, lesions=(1, 3), normals=1, seed=0):
+    """
+    Write a fake DDSM tree under root/cases: .ics files with all four sequences,
+    .OVERLAY files with long chain codes for masses and calcifications, and
+    big-endian .LJPEG.1 rasters drawn from a breast-like optical density image
+    through each scanner's calibration, so everything downstream sees realistic
+    sizes and values
+    :param root: output root, the tree is written under root/cases
+    :param cases: number of cases with lesions
+    :param height: rows of each view
+    :param width: columns of each view
+    :param lesions: (low, high) number of lesions on each view with lesions
+    :param normals: number of extra cases without lesions
+    :param seed: random seed, the same arguments always write the same corpus
+    :return: list of case directories
+    """
+    rng = np.random.RandomState(seed)
+    case_dirs = []
+
+    for case_num in range(cases + normals):
+        letter, digitizer, bpp, resolution = scanners[case_num % len(scanners)]
+        scanner_type = digitizer.split()[0]
+        scan_institution = scanner_map[(letter, scanner_type)]
+
+        if case_num < cases:
+            directory, prefix, pathology = volumes[case_num % len(volumes)]
+        else:
+            directory, prefix, pathology = 'normals', 'normal', None
+        case_dir = os.path.join(root, 'cases', directory, prefix + '_01', 'case{:04d}'.format(case_num))
+        if not os.path.exists(case_dir):
+            os.makedirs(case_dir)
+        case_dirs.append(case_dir)
+
+        patient_id = '{}-{:04d}-1'.format(letter, case_num)
+        with open(os.path.join(case_dir, patient_id + '.ics'), 'w') as f:
+            f.write("ics_version 1.0\n")
+            f.write("filename {}\n".format(patient_id))
+            f.write("DATE_OF_STUDY 1 1 1995\n")
+            f.write("PATIENT_AGE {}\n".format(rng.randint(35, 80)))
+            f.write("FILM\n")
+            f.write("FILM_TYPE REGULAR\n")
+            f.write("DENSITY {}\n".format(rng.randint(1, 5)))
+            f.write("DATE_DIGITIZED 1 1 1997\n")
+            f.write("DIGITIZER {}\n".format(digitizer))
+            f.write("SELECTED\n")
+            for sequence in sequences:
+                overlay = ' OVERLAY' if pathology and sequence.startswith('LEFT') else ' NON_OVERLAY'
+                f.write("{} LINES {} PIXELS_PER_LINE {} BITS_PER_PIXEL {} RESOLUTION {}{}\n".format(
+                    sequence, height, width, bpp, resolution, overlay))
+
+        for sequence in sequences:
+            side = sequence.split('_')[0]
+            base = os.path.join(case_dir, '{}.{}'.format(patient_id.replace('-', '_'), sequence))
+            od, breast = _view(height, width, side, rng)
+
+            # lesions on the left views of cases with lesions
+            if pathology and side == 'LEFT':
+                outlines = []
+                for abn_num in range(1, rng.randint(lesions[0], lesions[1] + 1) + 1):
+                    kind = 'mass' if rng.uniform() < 0.5 else 'calcification'
+                    points, lesion_type = _lesion(kind, height, width, breast, rng)
+                    outlines.append((abn_num, lesion_type, points))
+
+                    # lesions are denser than the tissue around them
+                    x_lo, y_lo = points.min(axis=0)
+                    x_hi, y_hi = points.max(axis=0)
+                    mask = Image.new('1', (x_hi - x_lo + 1, y_hi - y_lo + 1), 0)
+                    ImageDraw.Draw(mask).polygon((points - (x_lo, y_lo)).ravel().tolist(), outline=1, fill=1)
+                    od[y_lo:y_hi + 1, x_lo:x_hi + 1][np.array(mask, dtype=bool)] -= rng.uniform(0.1, 0.4)
+
+                with open(base + '.OVERLAY', 'w') as f:
+                    f.write("TOTAL_ABNORMALITIES {}\n".format(len(outlines)))
+                    for abn_num, lesion_type, points in outlines:
+                        x, y, codes = _chain_code(points)
+                        f.write("ABNORMALITY {}\n".format(abn_num))
+                        f.write(lesion_type + "\n")
+                        f.write("ASSESSMENT {}\n".format(rng.randint(2, 6)))
+                        f.write("SUBTLETY {}\n".format(rng.randint(1, 6)))
+                        f.write("PATHOLOGY {}\n".format(pathology))
+                        f.write("TOTAL_OUTLINES 1\n")
+                        f.write("BOUNDARY\n")
+                        f.write("{} {} {} #\n".format(x, y, ' '.join(str(c) for c in codes)))
+
+            _gray_levels(od, scanner_type, scan_institution, bpp).astype('>u2').tofile(base + '.LJPEG.1')
+
+    return case_dirs
+
+
+if __name__ == '__main__':
+    # synthetic_corpus.py root [cases [height width]]
+    args = [int(a) for a in sys.argv[2:5]]
+    make_synthetic_corpus(sys.argv[1], *args)
@@ -0,0 +1,165 @@
+import json
+import struct
+import zlib
+
+import numpy as np
+
+
+####################################################
+# Tiled multi-resolution image files
+####################################################
+# layout of a .tiles file
+#   magic (8 bytes) | index offset (uint64, little endian) | tiles ... | json index
+# tiles are zlib compressed C order arrays, row major within each level,
+# edge tiles are cut to the image. level 0 is full size and each level
+# after it is half the size of the one before, rounded up.
+magic = 'DDSMTILE'
+_header = struct.Struct('<8sQ')
+
+
+def _downsample(im):
+    """
+    Halve an image by averaging 2x2 blocks, odd edges are repeated
+    :param im: 2d image
+    :return: image of shape ceil(shape / 2) and the same dtype
+    """
+    h, w = im.shape
+    dtype = im.dtype
+    im = np.pad(im, ((0, h % 2), (0, w % 2)), mode='edge').astype(np.uint32)
+    blocks = im[0::2, 0::2] + im[1::2, 0::2] + im[0::2, 1::2] + im[1::2, 1::2]
+    return ((blocks + 2) // 4).astype(dtype)
+
+
+def write_tiled(path, im, tile_size=256, min_size=None, compress_level=1):
+    """
+    Write an image with its downsampled pyramid as compressed tiles
+    :param path: output path, normally ending in .tiles
+    :param im: 2d uint8 or uint16 image
+    :param tile_size: width and height of the tiles
+    :param min_size: stop adding levels once the image fits in this size, defaults to tile_size
+    :param compress_level: zlib compression level
+    :return: None
+    """
+    if min_size is None:
+        min_size = tile_size
+
+    dtype = im.dtype
+    index = {'dtype': dtype.str, 'tile_size': tile_size, 'levels': []}
+
+    with open(path, 'wb') as f:
+        f.write(_header.pack(magic, 0))
+
+        while True:
+            h, w = im.shape
+            offsets = []
+            for y in range(0, h, tile_size):
+                for x in range(0, w, tile_size):
+                    tile = np.ascontiguousarray(im[y:y + tile_size, x:x + tile_size])
+                    offsets.append(f.tell())
+                    f.write(zlib.compress(tile.tostring(), compress_level))
+            offsets.append(f.tell())  # end of the last tile
+            index['levels'].append({'shape': [h, w], 'offsets': offsets})
+
+            if max(h, w) <= min_size:
+                break
+            im = _downsample(im)
+
+        index_offset = f.tell()
+        f.write(json.dumps(index))
+        f.seek(0)
+        f.write(_header.pack(magic, index_offset))
+
+
+class tiled_image(object):
+    """
+    Reader for files written by write_tiled. Windows are assembled
+    from only the tiles they overlap.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: .tiles file
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+
+        file_magic, index_offset = _header.unpack(self._file.read(_header.size))
+        if file_magic != magic:
+            raise ValueError("{} is not a tiled image".format(path))
+
+        self._file.seek(index_offset)
+        index = json.loads(self._file.read())
+        self.dtype = np.dtype(str(index['dtype']))
+        self.tile_size = index['tile_size']
+        self._levels = index['levels']
+
+    @property
+    def levels(self):
+        return len(self._levels)
+
+    def shape(self, level=0):
+        """
+        :param level: pyramid level, 0 is full size
+        :return: (height, width) of the level
+        """
+        return tuple(self._levels[level]['shape'])
+
+    def read_tile(self, level, ty, tx):
+        """
+        :param level: pyramid level
+        :param ty: tile row
+        :param tx: tile column
+        :return: the tile, smaller than tile_size at the bottom and right edges
+        """
+        h, w = self.shape(level)
+        tiles_x = -(-w // self.tile_size)
+        i = ty * tiles_x + tx
+        offsets = self._levels[level]['offsets']
+
+        self._file.seek(offsets[i])
+        data = zlib.decompress(self._file.read(offsets[i + 1] - offsets[i]))
+
+        th = min(self.tile_size, h - ty * self.tile_size)
+        tw = min(self.tile_size, w - tx * self.tile_size)
+        return np.frombuffer(data, dtype=self.dtype).reshape(th, tw)
+
+    def read_window(self, y, x, height, width, level=0):
+        """
+        :param y: top row of the window, in pixels of the level
+        :param x: left column of the window, in pixels of the level
+        :param height: window height
+        :param width: window width
+        :param level: pyramid level
+        :return: the window, clipped to the image
+        """
+        h, w = self.shape(level)
+        y_lo, x_lo = max(0, y), max(0, x)
+        y_hi, x_hi = min(h, y + height), min(w, x + width)
+        window = np.zeros((max(0, y_hi - y_lo), max(0, x_hi - x_lo)), dtype=self.dtype)
+
+        t = self.tile_size
+        for ty in range(y_lo // t, -(-y_hi // t)):
+            for tx in range(x_lo // t, -(-x_hi // t)):
+                tile = self.read_tile(level, ty, tx)
+                ty_lo, tx_lo = max(y_lo, ty * t), max(x_lo, tx * t)
+                ty_hi, tx_hi = min(y_hi, ty * t + t), min(x_hi, tx * t + t)
+                window[ty_lo - y_lo:ty_hi - y_lo, tx_lo - x_lo:tx_hi - x_lo] = \
+                    tile[ty_lo - ty * t:ty_hi - ty * t, tx_lo - tx * t:tx_hi - tx * t]
+        return window
+
+    def read_level(self, level):
+        """
+        :param level: pyramid level
+        :return: the whole level
+        """
+        h, w = self.shape(level)
+        return self.read_window(0, 0, h, w, level)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
@@ -0,0 +1,57 @@
+import glob
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ddsm_tools'))
+
+from ljpeg import decode_ljpeg, read_ljpeg
+
+# 23x19 images encoded with jpegdir/jpeg, next to the .LJPEG.1 files the
+# codec writes when decompressing them, named after the predictor and options
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'ljpeg')
+
+
+class test_read_ljpeg(unittest.TestCase):
+
+    def test_fixtures_cover_predictors(self):
+        names = [os.path.basename(p) for p in glob.glob(os.path.join(data_dir, '*.LJPEG'))]
+        self.assertEqual(sorted(names), ['pred1.LJPEG', 'pred1_16bit.LJPEG', 'pred2_restart.LJPEG', 'pred3.LJPEG',
+                                         'pred4.LJPEG', 'pred5_shift2.LJPEG', 'pred6.LJPEG', 'pred7.LJPEG'])
+
+    def test_matches_codec(self):
+        for ljpeg_path in sorted(glob.glob(os.path.join(data_dir, '*.LJPEG'))):
+            im = read_ljpeg(ljpeg_path)
+            ref = np.fromfile(ljpeg_path + '.1', dtype='>u2')
+
+            self.assertEqual(im.dtype, np.uint16)
+            self.assertEqual(im.shape, (19, 23))
+            np.testing.assert_array_equal(im, ref.reshape(im.shape), err_msg=ljpeg_path)
+
+
+class test_malformed_ljpeg(unittest.TestCase):
+
+    def setUp(self):
+        with open(os.path.join(data_dir, 'pred1.LJPEG'), 'rb') as f:
+            self.data = f.read()
+
+    def test_truncated(self):
+        for size in range(0, 300):
+            self.assertRaises(ValueError, decode_ljpeg, self.data[:size])
+
+    def test_undefined_huffman_table(self):
+        # point the scan at huffman table 1, which the file doesn't define
+        sos = self.data.index('\xff\xda')
+        data = self.data[:sos + 6] + chr(0x10) + self.data[sos + 7:]
+        self.assertRaises(ValueError, decode_ljpeg, data)
+
+    def test_huffman_table_id_out_of_range(self):
+        dht = self.data.index('\xff\xc4')
+        data = self.data[:dht + 4] + chr(ord(self.data[dht + 4]) | 0x0F) + self.data[dht + 5:]
+        self.assertRaises(ValueError, decode_ljpeg, data)
+
+
+if __name__ == '__main__':
+    unittest.main()
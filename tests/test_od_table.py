@@ -0,0 +1,88 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ddsm_tools'))
+
+from ddsm_classes import ddsm_abnormality
+from ddsm_util import scanner_map
+
+
+def _abnormality(scan_institution, scanner_type):
+    """
+    :return: ddsm_abnormality with only the scanner set, enough for the od methods
+    """
+    abnormality = ddsm_abnormality.__new__(ddsm_abnormality)
+    abnormality.scan_institution = scan_institution
+    abnormality.scanner_type = scanner_type
+    return abnormality
+
+
+def _baseline_od(scan_institution, scanner_type, im):
+    """
+    The float conversion save_image did before the lookup tables, kept
+    as it was so the tables are checked against it and not against themselves
+    :param im: native uint16 raw image
+    :return: uint8 od image
+    """
+    im_od = np.zeros_like(im, dtype=np.float64)
+
+    if (scan_institution == 'MGH') and (scanner_type == 'DBA'):
+        im_od = (np.log10(im + 1) - 4.80662) / -1.07553  # add 1 to keep from log(0)
+    elif (scan_institution == 'MGH') and (scanner_type == 'HOWTEK'):
+        im_od = (-0.00094568 * im) + 3.789
+    elif (scan_institution == 'WFU') and (scanner_type == 'LUMISYS'):
+        im_od = (im - 4096.99) / -1009.01
+    elif (scan_institution == 'ISMD') and (scanner_type == 'HOWTEK'):
+        im_od = (-0.00099055807612 * im) + 3.96604095240593
+
+    # perform heath noise correction
+    im_od[im_od < 0.05] = 0.05
+    im_od[im_od > 3.0] = 3.0
+
+    im_array = np.interp(im_od, (0.0, 4.0), (255, 0))
+    return im_array.astype(np.uint8)
+
+
+class test_od_table(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+
+        # every 16 bit gray level once, shuffled into a 256x256 raster
+        self.raster = np.random.RandomState(3).permutation(65536).astype(np.uint16).reshape(256, 256)
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_matches_float_conversion(self):
+        # every scanner, and one that falls through to the unknown scanner branch
+        scanners = sorted(set((institution, scanner_type) for (_, scanner_type), institution in scanner_map.items()))
+        scanners.append(('MGH', 'LUMISYS'))
+
+        for scan_institution, scanner_type in scanners:
+            with np.errstate(divide='ignore'):  # 65535 + 1 wraps to 0 for DBA
+                expected = _baseline_od(scan_institution, scanner_type, self.raster)
+
+            # decompressed images are read as big-endian memmaps
+            for raw in [self.raster, self.raster.astype('>u2')]:
+                im_path = os.path.join(self.out_dir, '{}_{}.tif'.format(scan_institution, scanner_type))
+                _abnormality(scan_institution, scanner_type)._write_image(im_path, raw, od_correct=True)
+
+                im = np.array(Image.open(im_path))
+                self.assertEqual(im.dtype, np.uint8)
+                np.testing.assert_array_equal(im, expected, err_msg="{} {}".format(scan_institution, scanner_type))
+
+    def test_unknown_scanner_is_clipped_zero(self):
+        # od 0 is clipped to 0.05, which maps to 251
+        table = _abnormality('MGH', 'LUMISYS')._od_table()
+        self.assertTrue((table == np.uint8(255 * (1 - 0.05 / 4.0))).all())
+
+
+if __name__ == '__main__':
+    unittest.main()